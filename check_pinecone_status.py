@@ -6,6 +6,10 @@ Script to check the status of the Pinecone index and see what PDFs have been pro
 """
 
 import os
+import json
+import time
+import functools
+from cachetools.func import ttl_cache
 from dotenv import load_dotenv
 from pinecone import Pinecone
 
@@ -13,21 +17,85 @@ from pinecone import Pinecone
 load_dotenv()
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 
+# How long (seconds) index listings, stats and the source list may be reused
+POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", "300"))
+
+# Where the enumerated source list is cached between runs
+SOURCES_CACHE_FILE = ".pinecone_sources.json"
+
+@functools.lru_cache(maxsize=1)
+def _get_client():
+    return Pinecone(api_key=PINECONE_API_KEY)
+
+@ttl_cache(maxsize=1, ttl=POLL_INTERVAL)
+def _cached_indexes():
+    """List indexes, reusing the answer for POLL_INTERVAL seconds"""
+    return _get_client().list_indexes()
+
+@ttl_cache(maxsize=4, ttl=POLL_INTERVAL)
+def _cached_stats(index_name="form"):
+    """Describe index stats, reusing the answer for POLL_INTERVAL seconds"""
+    return _get_client().Index(index_name).describe_index_stats()
+
+@functools.lru_cache(maxsize=8)
+def _scan_pdf_files(data_dir, mtime_ns):
+    """List PDFs in data_dir; mtime_ns is only part of the cache key"""
+    with os.scandir(data_dir) as entries:
+        return tuple(e.name for e in entries if e.name.endswith('.pdf') and e.is_file(follow_symlinks=False))
+
+def list_pdf_files(data_dir="data"):
+    """List PDFs in data_dir, rescanning only when the directory has changed"""
+    return _scan_pdf_files(data_dir, os.stat(data_dir).st_mtime_ns)
+
+def list_indexed_sources(index, namespace="formulary", fetch_batch_size=1000):
+    """Enumerate every distinct 'source' in a namespace by walking vector IDs"""
+    # Reuse a recent scan if there is one
+    try:
+        with open(SOURCES_CACHE_FILE) as f:
+            cached = json.load(f)
+        if cached.get('namespace') == namespace and time.time() - cached.get('timestamp', 0) < POLL_INTERVAL:
+            return set(cached['sources'])
+    except (OSError, ValueError):
+        pass
+    
+    sources = set()
+    
+    def fetch_sources(ids):
+        fetched = index.fetch(ids=ids, namespace=namespace)
+        for vector in fetched.vectors.values():
+            if vector.metadata and 'source' in vector.metadata:
+                sources.add(vector.metadata['source'])
+    
+    # index.list yields pages of IDs; fetch metadata in large batches
+    pending = []
+    for ids in index.list(namespace=namespace):
+        pending.extend(ids)
+        while len(pending) >= fetch_batch_size:
+            fetch_sources(pending[:fetch_batch_size])
+            pending = pending[fetch_batch_size:]
+    if pending:
+        fetch_sources(pending)
+    
+    try:
+        with open(SOURCES_CACHE_FILE, 'w') as f:
+            json.dump({'namespace': namespace, 'timestamp': time.time(), 'sources': sorted(sources)}, f)
+    except OSError as e:
+        print(f"Could not cache source list: {e}")
+    
+    return sources
+
 def check_pinecone_status():
     """Check the status of the Pinecone index"""
     try:
-        # Initialize Pinecone
-        pc = Pinecone(api_key=PINECONE_API_KEY)
-        
         # List available indexes
-        indexes = pc.list_indexes()
+        indexes = _cached_indexes()
         print(f"Available Pinecone indexes: {indexes.names()}")
         
         # Connect to the 'form' index
-        index = pc.Index("form")
+        index = _get_client().Index("form")
         
         # Get index stats
-        stats = index.describe_index_stats()
+        stats = _cached_stats("form")
         print(f"\nIndex statistics: {stats}")
         
         # Check which PDFs have been processed
@@ -37,20 +105,8 @@ def check_pinecone_status():
         else:
             print("\nNo vectors found in 'formulary' namespace")
         
-        # Query to see what sources are in the index
-        query_embedding = [0.1] * 1024  # Create a dummy vector for querying
-        results = index.query(
-            namespace="formulary",
-            vector=query_embedding,
-            top_k=100,  # Get a large number to see more sources
-            include_metadata=True
-        )
-        
-        # Extract unique source files
-        sources = set()
-        for match in results.matches:
-            if hasattr(match, 'metadata') and match.metadata and 'source' in match.metadata:
-                sources.add(match.metadata['source'])
+        # Enumerate the sources stored in the index
+        sources = list_indexed_sources(index, namespace="formulary")
         
         # Print the sources
         print(f"\nFound {len(sources)} unique source files in Pinecone:")
@@ -59,7 +115,7 @@ def check_pinecone_status():
         
         # Compare with files in data directory
         data_dir = "data"
-        pdf_files = [f for f in os.listdir(data_dir) if f.endswith('.pdf')]
+        pdf_files = list_pdf_files(data_dir)
         
         print(f"\nTotal PDF files in data directory: {len(pdf_files)}")
         
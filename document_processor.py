@@ -1,27 +1,26 @@
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
-from matplotlib.patches import Patch
-import io
-from PIL import Image, ImageDraw
 import numpy as np
-import csv
 import pandas as pd
-
-from torchvision import transforms
-
-from transformers import AutoModelForObjectDetection
-import torch
 import openai
 import os
+import re
+import time
+import json
+import asyncio
+import random
+import functools
+import queue
+import hashlib
+import sqlite3
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 import fitz  # PyMuPDF
-import numpy as np
-from sklearn.decomposition import PCA
+import httpx
+import tiktoken
 
-# We'll use a simpler approach without LlamaIndex document objects
-# since the import structure may vary between versions
-
-# Set device for PyTorch
-device = "cuda" if torch.cuda.is_available() else "cpu"
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # Load API keys from environment variables
 from dotenv import load_dotenv
@@ -35,219 +34,582 @@ openai.api_key = OPENAI_API_KEY
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 PINECONE_ENV = os.getenv("PINECONE_ENVIRONMENT")
 
+# Decimal places kept in vector values upserted over REST. Components of a unit-length 1024-d
+# vector are around 1e-2, so this moves cosine scores by ~1e-5 while cutting JSON upsert payloads
+# to well under half.
+UPSERT_DECIMALS = 5
+
+def open_pinecone_index(index_name="form"):
+    """Connect to a Pinecone index, over gRPC when the pinecone-client[grpc] extra is installed"""
+    try:
+        from pinecone.grpc import PineconeGRPC as Pinecone
+    except ImportError:
+        from pinecone import Pinecone
+    return Pinecone(api_key=PINECONE_API_KEY).Index(index_name)
+
+def vector_id(metadata):
+    """
+    Deterministic Pinecone vector ID built only from stable fields of an entry's metadata, so
+    every ingestion script gives the same item the same ID and re-ingesting overwrites in place
+    
+    Text: "<source>::<type>::<chunk_idx>", where each chunker has its own type name, so windows
+    from different chunkers never overwrite each other. Tables: "<source>::table::p<page>t<table_num>"
+    (table_num counts tables on the page). Full text: "<source>::full_text::0".
+    """
+    source, kind = metadata['source'], metadata['type']
+    if kind == 'table':
+        return f"{source}::table::p{metadata['page']}t{metadata['table_num']}"
+    return f"{source}::{kind}::{metadata.get('chunk_idx', 0)}"
+
+def _is_grpc_index(index):
+    """True for an index handle from the pinecone-client[grpc] transport"""
+    return type(index).__module__.startswith("pinecone.grpc")
+
+# Append-only record of the source files whose vectors are in Pinecone
+PROCESSED_LEDGER = "processed.jsonl"
+
+def record_processed_sources(sources, ledger_path=PROCESSED_LEDGER):
+    """Append source filenames to the processed ledger after a successful upsert"""
+    lines = "".join(json.dumps({"source": source, "ts": time.time()}) + "\n" for source in sorted(sources))
+    with open(ledger_path, "a") as f:
+        # Exclusive lock so concurrent ingestion runs never interleave lines
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(lines)
+        f.flush()
+
+def read_processed_sources(ledger_path=PROCESSED_LEDGER):
+    """Return the set of processed source filenames, or None if there is no ledger yet"""
+    try:
+        with open(ledger_path) as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_SH)
+            return {json.loads(line)["source"] for line in f if line.strip()}
+    except FileNotFoundError:
+        return None
+
+# Filename token -> insurance provider, in match priority order
+INSURANCE_PROVIDERS = {
+    "UHC": "UnitedHealthcare",
+    "BCBS": "Blue Cross Blue Shield",
+    "Cigna": "Cigna",
+    "Express Scripts": "Express Scripts",
+    "Humana": "Humana",
+    "Meridian": "Meridian",
+    "Wellcare": "Wellcare",
+    "County Care": "County Care"
+}
+PLAN_TYPES = ("HMO", "PPO", "Medicare")
+
+_PROVIDER_RE = re.compile("|".join(map(re.escape, INSURANCE_PROVIDERS)))
+_PLAN_RE = re.compile("|".join(PLAN_TYPES))
+
+@functools.lru_cache(maxsize=256)
+def get_insurance_from_filename(filename):
+    """Extract insurance provider (and plan type, if any) from a formulary filename"""
+    # One scan per pattern; ties go to the earlier entry, as with the original if-chains
+    found = set(_PROVIDER_RE.findall(filename))
+    provider = next((key for key in INSURANCE_PROVIDERS if key in found), None)
+    if provider is None:
+        return "Unknown Insurance"
+    
+    plans = set(_PLAN_RE.findall(filename))
+    plan = next((plan for plan in PLAN_TYPES if plan in plans), None)
+    return f"{INSURANCE_PROVIDERS[provider]} {plan}" if plan else INSURANCE_PROVIDERS[provider]
+
+# Provider names and abbreviations as written in questions -> the insurance value stored in
+# vector metadata (the provider part of get_insurance_from_filename)
+PROVIDER_ALIASES = {
+    **{name: name for name in INSURANCE_PROVIDERS.values()},
+    **INSURANCE_PROVIDERS,
+    "United Healthcare": "UnitedHealthcare",
+    "Blue Cross": "Blue Cross Blue Shield",
+    "CountyCare": "County Care",
+}
+_PROVIDER_ALIAS_NAMES = {alias.lower(): name for alias, name in PROVIDER_ALIASES.items()}
+# Longest first so "Blue Cross Blue Shield" wins over "Blue Cross"
+_PROVIDER_ALIAS_RE = re.compile(
+    r"\b(?:" + "|".join(re.escape(a) for a in sorted(_PROVIDER_ALIAS_NAMES, key=len, reverse=True)) + r")\b",
+    re.IGNORECASE
+)
+
+def find_providers(text):
+    """Return the insurance providers named in text, first mention first, as stored in metadata"""
+    providers = []
+    for match in _PROVIDER_ALIAS_RE.finditer(text):
+        provider = _PROVIDER_ALIAS_NAMES[match.group(0).lower()]
+        if provider not in providers:
+            providers.append(provider)
+    return providers
+
+def insurance_filter(provider):
+    """Pinecone metadata filter matching a provider and its plan-specific variants"""
+    provider = PROVIDER_ALIASES.get(provider, provider)
+    return {"insurance": {"$in": [provider] + [f"{provider} {plan}" for plan in PLAN_TYPES]}}
+
+# Inhaler class -> terms that mark text as covering it: the abbreviation, generics and brands
+# (combination products are listed under every class they contain)
+MED_CLASS_TERMS = {
+    "SABA": ("SABA", "albuterol", "levalbuterol", "ProAir", "Ventolin", "Proventil", "Xopenex"),
+    "ICS": ("ICS", "fluticasone", "budesonide", "beclomethasone", "mometasone", "ciclesonide",
+            "Flovent", "Arnuity", "Pulmicort", "QVAR", "Asmanex", "Alvesco",
+            "Advair", "Wixela", "AirDuo", "Symbicort", "Breyna", "Dulera", "Breo", "Trelegy", "Breztri"),
+    "LABA": ("LABA", "salmeterol", "formoterol", "arformoterol", "indacaterol", "olodaterol", "vilanterol",
+             "Serevent", "Foradil", "Arcapta", "Striverdi",
+             "Advair", "Wixela", "AirDuo", "Symbicort", "Breyna", "Dulera", "Breo",
+             "Anoro", "Stiolto", "Bevespi", "Trelegy", "Breztri"),
+    "LAMA": ("LAMA", "tiotropium", "umeclidinium", "aclidinium", "glycopyrrolate", "glycopyrronium", "revefenacin",
+             "Spiriva", "Incruse", "Tudorza", "Seebri", "Yupelri",
+             "Anoro", "Stiolto", "Bevespi", "Trelegy", "Breztri")
+}
+_MED_CLASS_RES = {
+    med_class: re.compile(r"\b(?:" + "|".join(map(re.escape, terms)) + r")\b", re.IGNORECASE)
+    for med_class, terms in MED_CLASS_TERMS.items()
+}
+
+def get_med_classes(text):
+    """Return the inhaler classes (SABA, ICS, LABA, LAMA) that a piece of text mentions"""
+    return [med_class for med_class, pattern in _MED_CLASS_RES.items() if pattern.search(text)]
+
+# Every drug, brand and class term above in one alternation, longest first
+_DRUG_TERMS = {term.lower() for terms in MED_CLASS_TERMS.values() for term in terms}
+_DRUG_TERM_RE = re.compile(
+    r"\b(?:" + "|".join(re.escape(t) for t in sorted(_DRUG_TERMS, key=len, reverse=True)) + r")\b",
+    re.IGNORECASE
+)
+
+def cache_partition(text):
+    """
+    Semantic response-cache partition for a question: the providers and the exact drug, brand
+    or class terms it names, so questions about different drugs in the same class (Flovent vs
+    Pulmicort) never share an answer. None when no known term is named; such questions should
+    only use exact matches, since nothing tells apart the drugs they ask about.
+    """
+    terms = sorted({match.group(0).lower() for match in _DRUG_TERM_RE.finditer(text)})
+    if not terms:
+        return None
+    return "|".join((",".join(sorted(find_providers(text))), ",".join(terms)))
+
+@functools.lru_cache(maxsize=1)
+def _embedding_encoding():
+    """Tokenizer for text-embedding-ada-002, loaded once on first use"""
+    return tiktoken.encoding_for_model("text-embedding-ada-002")
+
+@functools.lru_cache(maxsize=1)
+def _gpt4o_encoding():
+    """Tokenizer for GPT-4o, loaded once on first use"""
+    return tiktoken.encoding_for_model("gpt-4o")
+
+def _extract_one(pdf_path):
+    """Extract text and tables from a PDF in a single pass; top-level so it can run in a worker process"""
+    text_parts = []
+    tables = []
+    try:
+        doc = fitz.open(pdf_path)
+        for page_num, page in enumerate(doc):
+            text_parts.append(page.get_text())
+            try:
+                for i, table in enumerate(page.find_tables().tables):
+                    tables.append({
+                        'page': page_num + 1,
+                        'table_num': i + 1,
+                        'source': 'pymupdf',
+                        'data': table.to_pandas()
+                    })
+            except Exception as e:
+                print(f"Error extracting tables from {pdf_path} page {page_num + 1}: {e}")
+        doc.close()
+    except Exception as e:
+        print(f"Error extracting {pdf_path}: {e}")
+    return pdf_path, "".join(text_parts), tables
+
 class DocumentProcessor:
-    def __init__(self, pdf_dir="data"):
+    def __init__(self, pdf_dir="data", cache_path=None):
+        """
+        Args:
+            pdf_dir: Directory containing the formulary PDFs
+            cache_path: SQLite file for the embedding cache (defaults to $EMBED_CACHE_PATH,
+                then .embed_cache.db in pdf_dir)
+        """
         self.pdf_dir = pdf_dir
-        self.client = openai.OpenAI(api_key=OPENAI_API_KEY)
+        self._pdfs = None
+        # One client (and keep-alive connection pool) shared by embedding, analysis and batch calls
+        self.client = openai.OpenAI(
+            api_key=OPENAI_API_KEY,
+            http_client=httpx.Client(limits=httpx.Limits(max_connections=32, max_keepalive_connections=32))
+        )
+        
+        # Subsample positions for reducing ada-002 vectors (1536) to the Pinecone index dimension (1024)
+        self._resize_indices = np.round(np.linspace(0, 1535, 1024)).astype(np.intp)
+        
+        # Raw embeddings keyed by model and content hash, so unchanged text is never re-embedded
+        # and a rerun after a partial failure only pays for what did not finish
+        cache_path = cache_path or os.getenv("EMBED_CACHE_PATH") or os.path.join(pdf_dir, ".embed_cache.db")
+        self._cache = None
+        self._cache_lock = threading.Lock()
+        try:
+            self._cache = sqlite3.connect(cache_path, check_same_thread=False)
+            self._cache.execute("PRAGMA journal_mode=WAL")
+            self._cache.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB)")
+            self._cache.commit()
+        except sqlite3.Error as e:
+            print(f"Error opening embedding cache: {e}")
+            self._cache = None
         
     def get_embedding(self, text):
-        """Get embedding for text and resize to match Pinecone index dimensions (1024)"""
+        """Get embedding for text as a unit-length float32 array resized to the Pinecone index dimensions (1024)"""
+        return self._embed_batch([text])[0]
+    
+    def get_embeddings_batch(self, texts, batch_size=96):
+        """Get embeddings for several texts in as few API calls as possible, preserving input order"""
+        embeddings = [None] * len(texts)
+        for bucket in self._length_buckets(texts, batch_size):
+            for i, embedding in zip(bucket, self._embed_batch([texts[i] for i in bucket])):
+                embeddings[i] = embedding
+        return embeddings
+    
+    @staticmethod
+    def _length_buckets(texts, batch_size, max_ratio=4, max_chars=600_000):
+        """
+        Group text positions into request-sized batches of similar length
+        
+        Args:
+            texts: Texts to be embedded
+            batch_size: Maximum texts per batch
+            max_ratio: Maximum longest/shortest length ratio within a batch, so short
+                tables are not held up behind full-size text chunks
+            max_chars: Character budget per batch, well under the per-request token limit
+        """
+        buckets = []
+        bucket, shortest, total = [], 0, 0
+        for i in sorted(range(len(texts)), key=lambda i: len(texts[i])):
+            length = max(len(texts[i]), 1)
+            if bucket and (len(bucket) == batch_size or length > shortest * max_ratio or total + length > max_chars):
+                buckets.append(bucket)
+                bucket, total = [], 0
+            if not bucket:
+                shortest = length
+            bucket.append(i)
+            total += length
+        if bucket:
+            buckets.append(bucket)
+        return buckets
+    
+    def _embed_batch(self, texts):
+        """Embed one slice of texts, calling the API once for whatever is not already cached"""
         try:
-            # Truncate text if too long (embedding model has token limits)
-            max_tokens = 8000  # embedding models typically have 8k token limit
-            # Simple truncation - in production you'd want to chunk properly
-            if len(text) > max_tokens * 4:  # rough estimate of chars to tokens
-                text = text[:max_tokens * 4]
-            
-            # Use OpenAI's standard embedding model
-            response = self.client.embeddings.create(
-                model="text-embedding-ada-002",
-                input=text
-            )
-            
-            # Get the embedding vector
-            embedding = response.data[0].embedding
-            
-            # Resize to match Pinecone index dimensions (1024)
-            resized_embedding = self._resize_embedding(embedding, target_dim=1024)
+            inputs, keys, vectors, misses = self._lookup_cached(texts)
+            if misses:
+                response = self.client.embeddings.create(
+                    model="text-embedding-ada-002",
+                    input=[inputs[i] for i in misses]
+                )
+                self._store_fresh(response, keys, misses, vectors)
             
-            return resized_embedding
+            return list(self._resize_embeddings([vectors[key] for key in keys], target_dim=1024))
         except Exception as e:
-            print(f"Error getting embedding: {e}")
-            return None
+            print(f"Error getting embeddings: {e}")
+            return [None] * len(texts)
+    
+    def open_async_client(self):
+        """
+        New AsyncOpenAI client for one pipeline run, to pass to every get_embeddings_async call
         
-    def extract_text_from_pdf(self, pdf_path):
-        """Extract text from a PDF file"""
-        text = ""
-        try:
-            doc = fitz.open(pdf_path)
-            for page in doc:
-                text += page.get_text()
-            return text
-        except Exception as e:
-            print(f"Error extracting text from {pdf_path}: {e}")
-            return ""
+        The caller closes it (async with, or await client.close()) when the run finishes, on the
+        same event loop that used it.
+        """
+        return openai.AsyncOpenAI(
+            api_key=OPENAI_API_KEY,
+            http_client=httpx.AsyncClient(limits=httpx.Limits(max_connections=32, max_keepalive_connections=32))
+        )
+    
+    async def get_embeddings_async(self, texts, batch_size=96, concurrency=10, client=None):
+        """
+        Async get_embeddings_batch: slices are sent concurrently, at most `concurrency` in flight
+        
+        Pipelines pass the client from open_async_client so its connections are reused across
+        calls; without one, a client is opened and closed for this call alone.
+        """
+        if client is None:
+            async with self.open_async_client() as client:
+                return await self.get_embeddings_async(texts, batch_size, concurrency, client=client)
+        
+        semaphore = asyncio.Semaphore(concurrency)
+        buckets = self._length_buckets(texts, batch_size)
+        parts = await asyncio.gather(*[
+            self._embed_async(client, semaphore, [texts[i] for i in bucket])
+            for bucket in buckets
+        ])
+        embeddings = [None] * len(texts)
+        for bucket, part in zip(buckets, parts):
+            for i, embedding in zip(bucket, part):
+                embeddings[i] = embedding
+        return embeddings
     
-    def extract_tables_from_pdf(self, pdf_path):
-        """Extract tables from a PDF file using both PyMuPDF and LlamaIndex"""
-        tables = []
+    async def _embed_async(self, client, semaphore, texts, attempts=3):
+        """Embed one slice of texts, retrying rate limits and timeouts with exponential backoff"""
         try:
-            # Method 1: Extract tables using PyMuPDF
-            doc = fitz.open(pdf_path)
-            for page_num, page in enumerate(doc):
-                tab = page.find_tables()
-                if tab.tables:
-                    for i, table in enumerate(tab.tables):
-                        df = table.to_pandas()
-                        tables.append({
-                            'page': page_num + 1,
-                            'table_num': i + 1,
-                            'source': 'pymupdf',
-                            'data': df
-                        })
+            inputs, keys, vectors, misses = self._lookup_cached(texts)
+            if misses:
+                for attempt in range(attempts):
+                    try:
+                        async with semaphore:
+                            response = await client.embeddings.create(
+                                model="text-embedding-ada-002",
+                                input=[inputs[i] for i in misses]
+                            )
+                        break
+                    except (openai.RateLimitError, openai.APITimeoutError):
+                        if attempt == attempts - 1:
+                            raise
+                        await asyncio.sleep(2 ** attempt + random.random())
+                self._store_fresh(response, keys, misses, vectors)
             
-            # Method 2: Use standard PDFReader from LlamaIndex as a fallback
+            return list(self._resize_embeddings([vectors[key] for key in keys], target_dim=1024))
+        except Exception as e:
+            print(f"Error getting embeddings: {e}")
+            return [None] * len(texts)
+    
+    def _lookup_cached(self, texts):
+        """Truncate texts for the API and split them into cache hits and misses"""
+        inputs = [self._truncate_for_embedding(text) for text in texts]
+        keys = [self._cache_key(text) for text in inputs]
+        vectors = self._cache_get(keys)
+        misses = [i for i, key in enumerate(keys) if key not in vectors]
+        return inputs, keys, vectors, misses
+    
+    @staticmethod
+    def chunk_text(text, size=800, overlap=100):
+        """Split text into windows of `size` embedding tokens, each overlapping the previous by `overlap`"""
+        encoding = _embedding_encoding()
+        tokens = encoding.encode(text, disallowed_special=())
+        step = size - overlap
+        return [encoding.decode(tokens[start:start + size]) for start in range(0, max(len(tokens) - overlap, 1), step)]
+    
+    @staticmethod
+    def _truncate_for_embedding(text, max_tokens=8191):
+        """Cut text to the embedding model's per-input token limit, so one long item never fails a whole batch"""
+        # Even at 4 tokens per character, short texts cannot reach the limit; skip tokenizing them
+        if len(text) * 4 <= max_tokens:
+            return text
+        encoding = _embedding_encoding()
+        tokens = encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        return encoding.decode(tokens[:max_tokens])
+    
+    def _store_fresh(self, response, keys, misses, vectors):
+        """Add the raw embeddings from an API response to vectors and the cache"""
+        # The API returns one item per input, tagged with its position
+        data = sorted(response.data, key=lambda d: d.index)
+        fresh = {keys[i]: d.embedding for i, d in zip(misses, data)}
+        self._cache_put(fresh)
+        vectors.update(fresh)
+    
+    def embed_with_batch_api(self, items, poll_interval=30):
+        """
+        Embed many texts through the OpenAI Batch API (half the per-token cost, no per-request round-trips)
+        
+        Args:
+            items: (custom_id, text) pairs; custom_ids must be unique
+            poll_interval: Seconds between batch status checks
+        
+        Returns:
+            Dict of custom_id -> unit-length float32 embedding for every item that succeeded
+        """
+        inputs = {custom_id: self._truncate_for_embedding(text) for custom_id, text in items}
+        keys = {custom_id: self._cache_key(text) for custom_id, text in inputs.items()}
+        raw = {}
+        
+        # Only texts that have never been embedded go into the batch
+        cached = self._cache_get(list(set(keys.values()))) if keys else {}
+        misses = [custom_id for custom_id in inputs if keys[custom_id] not in cached]
+        for custom_id in inputs:
+            if keys[custom_id] in cached:
+                raw[custom_id] = cached[keys[custom_id]]
+        
+        if misses:
             try:
-                pdf_reader = PDFReader()
-                llama_docs = pdf_reader.load_data(pdf_path)
+                lines = "\n".join(json.dumps({
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": "/v1/embeddings",
+                    "body": {"model": "text-embedding-ada-002", "input": inputs[custom_id]}
+                }) for custom_id in misses)
+                input_file = self.client.files.create(file=("batch.jsonl", lines.encode("utf-8")), purpose="batch")
+                batch = self.client.batches.create(
+                    input_file_id=input_file.id,
+                    endpoint="/v1/embeddings",
+                    completion_window="24h"
+                )
+                print(f"Submitted embedding batch {batch.id} with {len(misses)} requests")
                 
-                # Look for potential tables in the text
-                for i, doc in enumerate(llama_docs):
-                    text = doc.text
-                    # Simple heuristic to detect tables: look for text with multiple lines and consistent delimiters
-                    lines = text.strip().split('\n')
-                    
-                    # Check if this might be a table (has multiple lines with similar structure)
-                    if len(lines) > 3:  # Need at least a few lines for a table
-                        # Try to detect table-like structures
-                        delimiter_counts = [line.count('|') for line in lines[:5] if line.strip()]
-                        space_pattern = [len(line.split()) for line in lines[:5] if line.strip()]
-                        
-                        # If consistent pattern of delimiters or spaces, might be a table
-                        if (len(set(delimiter_counts)) <= 2 and max(delimiter_counts) > 1) or \
-                           (len(set(space_pattern)) <= 2 and min(space_pattern) >= 3):
-                            
-                            # Try to create a DataFrame
-                            try:
-                                # For pipe-delimited tables
-                                if '|' in text:
-                                    # Get non-empty lines
-                                    table_lines = [line for line in lines if line.strip()]
-                                    if len(table_lines) > 1:
-                                        # First line as header
-                                        headers = [h.strip() for h in table_lines[0].split('|') if h.strip()]
-                                        data = []
-                                        for line in table_lines[1:]:  # Skip header
-                                            if '|' in line:
-                                                row = [cell.strip() for cell in line.split('|') if cell.strip()]
-                                                if row:
-                                                    data.append(row)
-                                        
-                                        if headers and data:
-                                            # Handle mismatched columns
-                                            max_cols = max(len(headers), max(len(row) for row in data))
-                                            headers = headers + [''] * (max_cols - len(headers))
-                                            data = [row + [''] * (max_cols - len(row)) for row in data]
-                                            df = pd.DataFrame(data, columns=headers)
-                                            
-                                            tables.append({
-                                                'page': doc.metadata.get('page_label', i+1),
-                                                'table_num': len(tables) + 1,
-                                                'source': 'llamaindex',
-                                                'data': df
-                                            })
-                                # For space-delimited tables
-                                else:
-                                    # Try pandas' read_csv with string buffer
-                                    import io
-                                    df = pd.read_csv(io.StringIO(text), sep='\\s+', engine='python')
-                                    if not df.empty:
-                                        tables.append({
-                                            'page': doc.metadata.get('page_label', i+1),
-                                            'table_num': len(tables) + 1,
-                                            'source': 'llamaindex_space',
-                                            'data': df
-                                        })
-                            except Exception as table_e:
-                                # Not a table or couldn't parse
-                                pass
-            except Exception as llama_e:
-                print(f"Error with LlamaIndex extraction: {llama_e}")
+                while batch.status not in ("completed", "failed", "expired", "cancelled"):
+                    time.sleep(poll_interval)
+                    batch = self.client.batches.retrieve(batch.id)
+                    print(f"Embedding batch {batch.id}: {batch.status}")
                 
-            return tables
-        except Exception as e:
-            print(f"Error extracting tables from {pdf_path}: {e}")
-            return []
+                if batch.output_file_id:
+                    fresh = {}
+                    for line in self.client.files.content(batch.output_file_id).text.splitlines():
+                        result = json.loads(line)
+                        response = result.get("response") or {}
+                        if response.get("status_code") != 200:
+                            continue
+                        raw[result["custom_id"]] = response["body"]["data"][0]["embedding"]
+                        fresh[keys[result["custom_id"]]] = raw[result["custom_id"]]
+                    self._cache_put(fresh)
+                
+                failed = len(misses) - sum(1 for custom_id in misses if custom_id in raw)
+                if failed:
+                    print(f"Embedding batch {batch.id} finished with status {batch.status}; {failed} requests failed")
+            except Exception as e:
+                print(f"Error running embedding batch: {e}")
+        
+        if not raw:
+            return {}
+        ids = list(raw)
+        resized = self._resize_embeddings([raw[custom_id] for custom_id in ids], target_dim=1024)
+        return dict(zip(ids, resized))
+    
+    @staticmethod
+    def _cache_key(text):
+        # Namespaced by model so switching models never returns stale vectors
+        return hashlib.sha256(("text-embedding-ada-002\0" + text).encode("utf-8")).hexdigest()
+    
+    def _cache_get(self, keys):
+        """Return {key: raw embedding} for the keys already in the embedding cache"""
+        if self._cache is None:
+            return {}
+        try:
+            with self._cache_lock:
+                rows = self._cache.execute(
+                    f"SELECT key, embedding FROM embeddings WHERE key IN ({','.join('?' * len(keys))})",
+                    keys
+                ).fetchall()
+        except sqlite3.Error as e:
+            print(f"Error reading embedding cache: {e}")
+            return {}
+        return {key: np.frombuffer(blob, dtype=np.float32) for key, blob in rows}
+    
+    def _cache_put(self, vectors):
+        """Store raw embeddings ({key: vector}) in the embedding cache"""
+        if self._cache is None:
+            return
+        try:
+            with self._cache_lock:
+                self._cache.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, embedding) VALUES (?, ?)",
+                    [(key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in vectors.items()]
+                )
+                self._cache.commit()
+        except sqlite3.Error as e:
+            print(f"Error writing embedding cache: {e}")
+        
+    def _pdf_paths(self):
+        """Paths of the PDFs in pdf_dir, listed once per processor"""
+        if self._pdfs is None:
+            with os.scandir(self.pdf_dir) as entries:
+                self._pdfs = [e.path for e in entries if e.name.endswith('.pdf') and e.is_file()]
+        return self._pdfs
+    
+    @staticmethod
+    def _has_enough_text(text, min_chars=200):
+        """Whether extracted text has enough content to be worth embedding (skips scans with no OCR text)"""
+        return bool(text) and len(text.strip()) >= min_chars
+    
+    @staticmethod
+    def _has_enough_cells(df):
+        """Whether a find_tables() result is a real table rather than a degenerate fragment"""
+        return isinstance(df, pd.DataFrame) and df.size >= 4 and df.notna().sum().sum() >= 2
+    
+    def extract_text_and_tables(self, pdf_path):
+        """Extract text and tables from a PDF file with a single pass over its pages"""
+        _, text, tables = _extract_one(pdf_path)
+        return text, tables
+    
+    def extract_many(self, pdf_paths, max_workers=None):
+        """Extract several PDFs across a process pool, yielding (pdf_path, text, tables) in input order"""
+        # Leave one core free for the parent process by default
+        max_workers = max_workers or max(1, (os.cpu_count() or 2) - 1)
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            yield from executor.map(_extract_one, pdf_paths)
     
     def process_all_pdfs(self):
         """Process all PDFs in the directory"""
         results = {}
-        for filename in os.listdir(self.pdf_dir):
-            if filename.endswith('.pdf'):
-                pdf_path = os.path.join(self.pdf_dir, filename)
-                print(f"Processing {filename}...")
-                
-                # Extract text
-                text = self.extract_text_from_pdf(pdf_path)
-                
-                # Extract tables
-                tables = self.extract_tables_from_pdf(pdf_path)
-                
-                # Create simple document structures for better querying
-                docs = []
-                
-                # Create a document from the full text
-                if text:
+        pending = []  # (filename, text to embed, embedding entry without its vector)
+        all_files = self._pdf_paths()
+        
+        # Parse PDFs across cores
+        for pdf_path, text, tables in self.extract_many(all_files):
+            filename = os.path.basename(pdf_path)
+            print(f"Processing {filename}...")
+            
+            # Create simple document structures for better querying
+            docs = []
+            
+            # Create a document from the full text and queue it for embedding
+            if self._has_enough_text(text):
+                docs.append({
+                    "text": text,
+                    "metadata": {"source": filename, "type": "full_text"}
+                })
+                pending.append((filename, text, {
+                    'content': text[:1000] + '...',  # Just store preview
+                    'metadata': {'source': filename, 'type': 'full_text', 'med_class': get_med_classes(text)}
+                }))
+            
+            # Create documents for each table and queue them for embedding
+            for table in tables:
+                if self._has_enough_cells(table['data']):
+                    # Render once as CSV (far fewer tokens than padded to_string output), capped
+                    # so very large tables stay well under the embedding input limit
+                    table_str = table['data'].iloc[:200, :40].to_csv(index=False)
                     docs.append({
-                        "text": text,
-                        "metadata": {"source": filename, "type": "full_text"}
+                        "text": f"Table from page {table['page']}, table #{table['table_num']}:\n{table_str}",
+                        "metadata": {
+                            "source": filename,
+                            "type": "table",
+                            "page": table['page'],
+                            "table_num": table['table_num']
+                        }
                     })
-                
-                # Create documents for each table
-                for table in tables:
-                    if isinstance(table['data'], pd.DataFrame) and not table['data'].empty:
-                        # Convert DataFrame to string representation
-                        table_str = table['data'].to_string()
-                        docs.append({
-                            "text": f"Table from page {table['page']}, table #{table['table_num']}:\n{table_str}",
-                            "metadata": {
-                                "source": filename,
-                                "type": "table",
-                                "page": table['page'],
-                                "table_num": table['table_num']
-                            }
-                        })
-                
-                # Create embeddings for text and tables
-                embeddings = []
-                
-                # Embedding for full text
-                if text:
-                    text_embedding = self.get_embedding(text)
-                    if text_embedding:
-                        embeddings.append({
-                            'content': text[:1000] + '...',  # Just store preview
-                            'embedding': text_embedding,
-                            'metadata': {'source': filename, 'type': 'full_text'}
-                        })
-                
-                # Embeddings for tables
-                for table in tables:
-                    if isinstance(table['data'], pd.DataFrame) and not table['data'].empty:
-                        table_str = table['data'].to_string()
-                        table_embedding = self.get_embedding(table_str)
-                        if isinstance(table_embedding, list) and len(table_embedding) > 0:
-                            embeddings.append({
-                                'content': f"Table from page {table['page']}:\n{table_str[:500]}...",
-                                'embedding': table_embedding,
-                                'metadata': {
-                                    'source': filename,
-                                    'type': 'table',
-                                    'page': table['page']
-                                }
-                            })
-                
-                results[filename] = {
-                    'text': text,
-                    'tables': tables,
-                    'docs': docs,
-                    'embeddings': embeddings
-                }
+                    pending.append((filename, table_str, {
+                        'content': f"Table from page {table['page']}:\n{table_str[:500]}...",
+                        'metadata': {
+                            'source': filename,
+                            'type': 'table',
+                            'page': table['page'],
+                            'table_num': table['table_num'],
+                            'med_class': get_med_classes(table_str)
+                        }
+                    }))
+            
+            results[filename] = {
+                'text': text,
+                'tables': tables,
+                'docs': docs,
+                'embeddings': []
+            }
+        
+        # Embed everything in batched API calls, then hand the vectors back to their files
+        vectors = self.get_embeddings_batch([item_text for _, item_text, _ in pending])
+        for (filename, _, item), embedding in zip(pending, vectors):
+            if embedding is not None:
+                results[filename]['embeddings'].append({**item, 'embedding': embedding})
         
         return results
     
     def analyze_formulary_with_gpt(self, text, tables=None, prompt=None):
-        """Analyze formulary text and tables with GPT"""
+        """
+        Analyze formulary text and tables with GPT
+        
+        Args:
+            text: Document text, truncated to the first 12k GPT-4o tokens
+            tables: Optional list of extracted tables; the first five are sent as their own message
+            prompt: Optional instructions replacing the default extraction prompt
+        """
         if prompt is None:
             prompt = """
             Analyze this formulary document and extract the following information:
@@ -262,13 +624,28 @@ class DocumentProcessor:
             """
         
         try:
-            client = openai.OpenAI(api_key=OPENAI_API_KEY)
-            response = client.chat.completions.create(
+            # Limit text by token count to stay inside the context window
+            encoding = _gpt4o_encoding()
+            text = encoding.decode(encoding.encode(text, disallowed_special=())[:12000])
+            
+            messages = [
+                {"role": "system", "content": "You are a pharmacy formulary specialist who extracts and structures medication information from formulary documents. You have expertise in respiratory medications, insurance formularies, and pharmacy benefit management."},
+                {"role": "user", "content": prompt + "\n\nDocument text:\n" + text}
+            ]
+            
+            # Send tables as a separate message so they stay structured and never get cut by the text limit
+            if tables:
+                table_text = "".join(
+                    f"\nTable from page {table['page']}:\n{table['data'].to_string(max_rows=10)}\n"
+                    for table in tables[:5]
+                    if isinstance(table['data'], pd.DataFrame) and not table['data'].empty
+                )
+                if table_text:
+                    messages.append({"role": "user", "content": "Tables from the document:\n" + table_text})
+            
+            response = self.client.chat.completions.create(
                 model="gpt-4o",  # Using GPT-4o for improved capabilities
-                messages=[
-                    {"role": "system", "content": "You are a pharmacy formulary specialist who extracts and structures medication information from formulary documents. You have expertise in respiratory medications, insurance formularies, and pharmacy benefit management."},
-                    {"role": "user", "content": prompt + "\n\nDocument text:\n" + text[:15000]}  # Limit text to avoid token limits
-                ]
+                messages=messages
             )
             return response.choices[0].message.content
         except Exception as e:
@@ -276,76 +653,61 @@ class DocumentProcessor:
             return ""
 
     def _resize_embedding(self, embedding, target_dim=1024):
-        """Resize an embedding vector to the target dimension using a simpler method"""
-        try:
-            # Convert to numpy array if it's not already
-            if not isinstance(embedding, np.ndarray):
-                embedding = np.array(embedding)
-            
-            # Get current dimensions
-            current_dim = embedding.shape[0]
-            
-            if current_dim == target_dim:
-                return embedding.tolist()
-            
-            # For dimensionality reduction, use a simpler approach
-            # We'll take a subset of the original dimensions and normalize
-            if current_dim > target_dim:
-                # Take every nth element to get target_dim elements
-                indices = np.round(np.linspace(0, current_dim - 1, target_dim)).astype(int)
-                reduced = embedding[indices]
-                
-                # Normalize to preserve the vector magnitude
-                norm = np.linalg.norm(reduced)
-                if norm > 0:
-                    reduced = reduced / norm
-                
-                return reduced.tolist()
-            
-            # If we need to increase dimensions, pad with zeros
-            if current_dim < target_dim:
-                padded = np.zeros(target_dim)
-                padded[:current_dim] = embedding
-                
-                # Normalize to preserve the vector magnitude
-                norm = np.linalg.norm(padded)
-                if norm > 0:
-                    padded = padded / norm
-                
-                return padded.tolist()
-            
-        except Exception as e:
-            print(f"Error resizing embedding: {e}")
-            # If resizing fails, create a random normalized vector
-            random_vec = np.random.randn(target_dim)
-            random_vec = random_vec / np.linalg.norm(random_vec)
-            return random_vec.tolist()
-    
-    def store_in_pinecone(self, embeddings, index_name="form", namespace="formulary"):
-        """Store embeddings in Pinecone using the existing index"""
+        """Resize an embedding vector to the target dimension, returned as a unit-length float32 array"""
+        return self._resize_embeddings([embedding], target_dim)[0]
+    
+    def _resize_embeddings(self, embeddings, target_dim=1024):
+        """Resize a batch of embeddings to the target dimension as an (N, target_dim) matrix of unit-length rows"""
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        current_dim = matrix.shape[1]
+        
+        if current_dim > target_dim:
+            # Take evenly spaced columns to get target_dim elements
+            if current_dim == 1536 and target_dim == 1024:
+                indices = self._resize_indices
+            else:
+                indices = np.round(np.linspace(0, current_dim - 1, target_dim)).astype(np.intp)
+            matrix = matrix[:, indices]
+        elif current_dim < target_dim:
+            # Pad with zeros
+            padded = np.zeros((matrix.shape[0], target_dim), dtype=np.float32)
+            padded[:, :current_dim] = matrix
+            matrix = padded
+        
+        # Unit length, so downstream cosine similarity is a plain dot product
+        return matrix / np.linalg.norm(matrix, axis=1, keepdims=True).clip(min=1e-12)
+    
+    def store_in_pinecone(self, embeddings, index_name="form", namespace="formulary", index=None):
+        """
+        Store embeddings in Pinecone using the existing index
+        
+        Args:
+            embeddings: Entries with 'embedding', 'content' and 'metadata' (IDs come from vector_id)
+            index_name: Index to connect to when no index handle is given
+            namespace: Namespace to upsert into
+            index: Optional open index handle, reused instead of reconnecting
+        """
         try:
-            from pinecone import Pinecone
-            import numpy as np
-            
             print(f"\nStoring {len(embeddings)} embeddings in Pinecone...")
             
-            # Initialize Pinecone with the exact approach from the documentation
-            pc = Pinecone(api_key=PINECONE_API_KEY)
+            if index is None:
+                # Connect to the existing index
+                index = open_pinecone_index(index_name)
+                print(f"Connected to existing index: {index_name}")
             
-            # Connect to the existing index
-            index = pc.Index(index_name)
-            print(f"Connected to existing index: {index_name}")
+            # Convert every vector to plain lists in one pass over a single matrix. Over REST each
+            # value is rounded so it serializes as a few digits instead of a full-precision float in
+            # the JSON body; gRPC sends packed float32 regardless, so rounding there is wasted work.
+            matrix = np.asarray([item['embedding'] for item in embeddings], dtype=np.float64)
+            if not _is_grpc_index(index):
+                matrix = np.round(matrix, UPSERT_DECIMALS)
+            values = matrix.tolist()
             
             # Prepare vectors for upsert in the exact format from the documentation
             vectors = []
-            for i, item in enumerate(embeddings):
-                # Convert numpy arrays to lists if needed
-                embedding = item['embedding']
-                if isinstance(embedding, np.ndarray):
-                    embedding = embedding.tolist()
-                
+            for item, embedding in zip(embeddings, values):
                 vectors.append({
-                    'id': f"{item['metadata']['source']}_{item['metadata']['type']}_{i}",
+                    'id': vector_id(item['metadata']),
                     'values': embedding,
                     'metadata': {
                         'content': item['content'],
@@ -353,82 +715,133 @@ class DocumentProcessor:
                     }
                 })
             
-            # Upsert in batches (Pinecone has limits)
+            # Upsert in batches (Pinecone has limits), several requests in flight at once
             batch_size = 100
-            for i in range(0, len(vectors), batch_size):
-                batch = vectors[i:i+batch_size]
-                index.upsert(vectors=batch, namespace=namespace)
-                print(f"Upserted batch {i//batch_size + 1}/{(len(vectors)-1)//batch_size + 1}")
+            batches = [vectors[i:i+batch_size] for i in range(0, len(vectors), batch_size)]
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                futures = [executor.submit(self._upsert_with_retry, index, batch, namespace) for batch in batches]
+                for batch_num, future in enumerate(futures, 1):
+                    future.result()
+                    print(f"Upserted batch {batch_num}/{len(batches)}")
             
             print(f"Successfully stored {len(vectors)} vectors in Pinecone index '{index_name}', namespace '{namespace}'")
             return True
         except Exception as e:
             print(f"Error storing in Pinecone: {e}")
             return False
+    
+    @staticmethod
+    def _upsert_with_retry(index, batch, namespace, max_retries=5):
+        """Upsert one batch, backing off with jitter while Pinecone rate-limits (HTTP 429 / gRPC RESOURCE_EXHAUSTED)"""
+        for attempt in range(max_retries + 1):
+            try:
+                return index.upsert(vectors=batch, namespace=namespace)
+            except Exception as e:
+                rate_limited = getattr(e, 'status', None) == 429 or '429' in str(e) or 'RESOURCE_EXHAUSTED' in str(e)
+                if not rate_limited or attempt == max_retries:
+                    raise
+                time.sleep(min(30, 2 ** attempt) * random.uniform(0.5, 1.5))
+
+class EmbeddingBatcher:
+    """Coalesce concurrent get_embedding calls into batched embedding requests"""
+    
+    def __init__(self, processor, batch_size=16, flush_interval=0.02):
+        self.processor = processor
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+    
+    def get_embedding(self, text):
+        """Queue text for the next batch and block until its embedding is ready"""
+        future = Future()
+        self._queue.put((text, future))
+        return future.result()
+    
+    def _run(self):
+        while True:
+            # Wait for the first item, then gather more until the batch fills or the window closes
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            try:
+                embeddings = self.processor.get_embeddings_batch([text for text, _ in batch])
+            except Exception as e:
+                print(f"Error in embedding batcher: {e}")
+                embeddings = [None] * len(batch)
+            
+            for (_, future), embedding in zip(batch, embeddings):
+                future.set_result(embedding)
 
 if __name__ == "__main__":
     # Create a test processor that only processes a few files
     processor = DocumentProcessor()
     
-    # Get list of PDF files
-    pdf_files = [f for f in os.listdir(processor.pdf_dir) if f.endswith('.pdf')]
-    
-    # Select just 2 files to test with
-    test_files = pdf_files[:2] if len(pdf_files) >= 2 else pdf_files
+    # Select just 2 PDF files to test with
+    pdf_paths = processor._pdf_paths()[:2]
+    test_files = [os.path.basename(path) for path in pdf_paths]
     
     print(f"Testing with {len(test_files)} files: {test_files}")
     
-    # Process just these files
+    # Process just these files: parse PDFs in a process pool and embed each one on a
+    # small thread pool as soon as it is parsed, so API latency overlaps with parsing
     all_embeddings = []
     results = {}
-    for filename in test_files:
-        pdf_path = os.path.join(processor.pdf_dir, filename)
-        print(f"Processing {filename}...")
-        
-        # Extract text
-        text = processor.extract_text_from_pdf(pdf_path)
-        
-        # Extract tables
-        tables = processor.extract_tables_from_pdf(pdf_path)
-        
-        # Create embeddings
-        embeddings = []
-        
-        # Embedding for full text
-        if text:
-            print(f"Creating embedding for full text...")
-            text_embedding = processor.get_embedding(text)
-            if isinstance(text_embedding, list) and len(text_embedding) > 0:
-                embeddings.append({
-                    'content': text[:1000] + '...',  # Just store preview
-                    'embedding': text_embedding,
-                    'metadata': {'source': filename, 'type': 'full_text'}
-                })
-        
-        # Embeddings for tables
-        for i, table in enumerate(tables):
-            if isinstance(table['data'], pd.DataFrame) and not table['data'].empty:
-                print(f"Creating embedding for table {i+1}...")
-                table_str = table['data'].to_string()
-                table_embedding = processor.get_embedding(table_str)
-                if table_embedding:
-                    embeddings.append({
-                        'content': f"Table from page {table['page']}:\n{table_str[:500]}...",
-                        'embedding': table_embedding,
-                        'metadata': {
-                            'source': filename,
-                            'type': 'table',
-                            'page': table['page']
-                        }
-                    })
-        
-        all_embeddings.extend(embeddings)
+    embed_jobs = []  # (filename, embedding entries without vectors, future of their vectors), in file order
+    with ThreadPoolExecutor(max_workers=5) as embed_pool:
+        with ProcessPoolExecutor(max_workers=max(1, (os.cpu_count() or 2) - 1)) as parse_pool:
+            for pdf_path, text, tables in parse_pool.map(_extract_one, pdf_paths):
+                filename = os.path.basename(pdf_path)
+                print(f"Processing {filename}...")
+                
+                # Queue text and tables for embedding
+                pending = []  # (text to embed, embedding entry without its vector)
+                if processor._has_enough_text(text):
+                    pending.append((text, {
+                        'content': text[:1000] + '...',  # Just store preview
+                        'metadata': {'source': filename, 'type': 'full_text', 'med_class': get_med_classes(text)}
+                    }))
+                
+                for table in tables:
+                    if processor._has_enough_cells(table['data']):
+                        table_str = table['data'].iloc[:200, :40].to_csv(index=False)
+                        pending.append((table_str, {
+                            'content': f"Table from page {table['page']}:\n{table_str[:500]}...",
+                            'metadata': {
+                                'source': filename,
+                                'type': 'table',
+                                'page': table['page'],
+                                'table_num': table['table_num'],
+                                'med_class': get_med_classes(table_str)
+                            }
+                        }))
+                
+                print(f"Creating {len(pending)} embeddings for {filename}...")
+                future = embed_pool.submit(processor.get_embeddings_batch, [item_text for item_text, _ in pending])
+                embed_jobs.append((filename, [item for _, item in pending], future))
+                
+                results[filename] = {
+                    'text': text,
+                    'tables': tables,
+                    'embeddings': []
+                }
         
-        results[filename] = {
-            'text': text,
-            'tables': tables,
-            'embeddings': embeddings
-        }
+        # Collect vectors in submission order so results match the file order
+        for filename, items, future in embed_jobs:
+            for item, embedding in zip(items, future.result()):
+                if embedding is not None:
+                    entry = {**item, 'embedding': embedding}
+                    results[filename]['embeddings'].append(entry)
+                    all_embeddings.append(entry)
     
     # Analyze just the first file
     if results:
@@ -448,14 +861,8 @@ if __name__ == "__main__":
         # Print embedding information
         print(f"\nCreated {len(embeddings)} embeddings for {first_pdf}")
         
-        # Add table information to the analysis
-        table_text = ""
-        for table in tables[:5]:  # Include first 5 tables in analysis
-            if isinstance(table['data'], pd.DataFrame) and not table['data'].empty:
-                table_text += f"\nTable from page {table['page']}:\n{table['data'].to_string(max_rows=10)}\n"
-        
         print(f"\nAnalyzing {first_pdf} with GPT-4o (including table data)...")
-        analysis = processor.analyze_formulary_with_gpt(text + "\n" + table_text if table_text else text)
+        analysis = processor.analyze_formulary_with_gpt(text, tables=tables)
         print(f"\nAnalysis of {first_pdf}:\n{analysis}")
         
         # Store embeddings in Pinecone
@@ -2,7 +2,7 @@ import os
 from typing import List
 from dotenv import load_dotenv
 # Updated LlamaIndex imports
-from llama_index.core import VectorStoreIndex, SimpleDirectoryReader, ServiceContext
+from llama_index.core import VectorStoreIndex, ServiceContext
 from llama_index.llms.openai import OpenAI
 from llama_index.vector_stores.pinecone import PineconeVectorStore
 from pydantic import BaseModel
@@ -12,6 +12,16 @@ import openai
 # Load environment variables
 load_dotenv()
 
+# Medication classes offered by the query interfaces, built once at import
+MEDICATION_CLASSES = (
+    "SABA (Short-Acting Beta Agonists)",
+    "ICS (Inhaled Corticosteroids)",
+    "ICS-LABA Combinations",
+    "LAMA Medications",
+    "LAMA-LABA Combinations",
+    "Triple Therapy (ICS-LABA-LAMA)"
+)
+
 class MedicationRecommendation(BaseModel):
     name: str
     form: str
@@ -55,17 +65,17 @@ class FormularyAgent:
             llm=OpenAI(temperature=0, model="gpt-4o", api_key=openai_api_key)
         )
         
-        # Load and chunk documents
-        self.documents = SimpleDirectoryReader(data_dir).load_data()
-        
-        # Use Pinecone as the vector store
-        vector_store = PineconeVectorStore(pinecone_index=pinecone_index)
+        # Use Pinecone as the vector store, reading the vectors document_processor.py wrote
+        vector_store = PineconeVectorStore(
+            pinecone_index=pinecone_index,
+            namespace="formulary",
+            text_key="content"
+        )
         
-        # Create the index
-        self.index = VectorStoreIndex.from_documents(
-            self.documents,
-            service_context=service_context,
-            vector_store=vector_store
+        # Attach to the existing vectors; ingestion is the only writer, so nothing is parsed or embedded here
+        self.index = VectorStoreIndex.from_vector_store(
+            vector_store,
+            service_context=service_context
         )
         self.query_engine = self.index.as_query_engine()
 
@@ -114,14 +124,7 @@ class FormularyAgent:
 
     def get_medication_classes(self) -> List[str]:
         """Return available medication classes"""
-        return [
-            "SABA (Short-Acting Beta Agonists)",
-            "ICS (Inhaled Corticosteroids)",
-            "ICS-LABA Combinations",
-            "LAMA Medications",
-            "LAMA-LABA Combinations",
-            "Triple Therapy (ICS-LABA-LAMA)"
-        ]
+        return list(MEDICATION_CLASSES)
 
 def main():
     # Create data directory if it doesn't exist
@@ -130,9 +133,9 @@ def main():
         print("Created 'data' directory. Please add your PDF formulary documents to this directory.")
         return
 
-    # Initialize the agent (loads PDFs, builds Pinecone RAG DB)
+    # Initialize the agent (connects to the Pinecone RAG DB built by document_processor.py)
     agent = FormularyAgent()
-    print("\nRAG database created and ready!")
+    print("\nRAG database connected and ready!")
 
     # Example usage
     print("Available medication classes:")
@@ -147,10 +150,11 @@ def main():
         insurance_name = input("Insurance name (e.g., UnitedHealthcare, Aetna): ")
         
         print("\nSelect medication class (enter number):")
-        for i, med_class in enumerate(agent.get_medication_classes(), 1):
+        medication_classes = agent.get_medication_classes()
+        for i, med_class in enumerate(medication_classes, 1):
             print(f"{i}. {med_class}")
         class_choice = int(input("\nChoice: "))
-        medication_class = agent.get_medication_classes()[class_choice-1]
+        medication_class = medication_classes[class_choice-1]
         
         print("\nBrand preference:")
         print("1. Generic preferred")
@@ -0,0 +1,21 @@
+"""
+Gunicorn Configuration
+----------------------
+Production settings for the Flask web interface (app.py).
+
+Usage: gunicorn -c gunicorn.conf.py app:app
+"""
+
+import os
+import multiprocessing
+
+bind = os.getenv("BIND", "0.0.0.0:5000")
+
+# Every route waits on Pinecone/OpenAI, so use cooperative gevent workers
+# that can hold many in-flight requests each
+worker_class = "gevent"
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_connections = 100
+
+# Streamed LLM answers can stay open for a while
+timeout = 120
@@ -7,12 +7,22 @@ based on insurance formularies and patient needs.
 """
 
 import os
+import re
 import sys
+import json
+import asyncio
+import argparse
+import functools
+import threading
 from typing import List, Dict, Any, Optional
+import numpy as np
 import openai
 import pandas as pd
+from cachetools import TTLCache
 from dotenv import load_dotenv
-from document_processor import DocumentProcessor
+from pinecone import Pinecone
+from document_processor import DocumentProcessor, get_med_classes, insurance_filter
+from semantic_cache import SemanticCache
 from formulary_agent import FormularyAgent, FormularyResponse
 
 # Load environment variables
@@ -20,12 +30,103 @@ load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 
+# Directory holding one persistent formulary-context cache per insurance provider
+CONTEXT_CACHE_DIR = os.getenv("CONTEXT_CACHE_DIR", ".context_cache")
+
+# Static instructions for every recommendation. Kept byte-identical across calls and placed
+# before the per-query fields so the message order stays fixed; at roughly 500 tokens it is
+# below OpenAI's 1024-token prompt-caching minimum, so no caching discount applies.
+RECOMMENDATION_SYSTEM_PROMPT = """You are a pharmacy formulary specialist who helps healthcare providers find the best inhaler options for their patients based on insurance coverage. You ALWAYS prioritize medications with the lowest tier (Tier 1 if available) as your primary recommendation, unless there are compelling clinical reasons to choose a higher tier option. You provide clear, structured recommendations with primary and alternative options.
+
+The user will give you the PATIENT NEEDS and the FORMULARY CONTEXT retrieved for their insurance. Please provide a structured recommendation including:
+1. PRIMARY RECOMMENDATION: Provide the best option based on the formulary with details on:
+   - Medication name (brand and generic)
+   - Form/device type
+   - Strength
+   - Formulary tier
+   - Prior authorization or step therapy requirements
+   - Quantity limits
+   - Estimated copay (if available)
+
+2. ALTERNATIVE OPTIONS: List 1-2 alternatives with key differences and requirements
+
+3. COVERAGE NOTES: Any important notes about coverage, restrictions, or special considerations
+
+Format your response in a clear, structured way that a healthcare provider can easily understand.
+
+FORMULARY TIER STRUCTURE:
+Tier 1: Typically includes the lowest-cost generic drugs, often with the lowest copays.
+Tier 2: May include more expensive generic drugs, some preferred brand-name drugs, and non-preferred brand-name drugs.
+Tier 3: Often contains preferred brand-name drugs, with some generic drugs for which there are lower-cost or over-the-counter alternatives.
+Tier 4: May include non-preferred brand-name drugs and some higher-cost generic drugs, as well as preferred specialty drugs.
+Tier 5: Typically reserved for specialty drugs, which are expensive medications used to treat specific conditions.
+Tier 6: Some plans may have a Tier 6 for select medications with lower copays, often including generics and some brand-name drugs for chronic conditions.
+
+IMPORTANT: Always prioritize medications with the lowest tier (Tier 1 if available) as your primary recommendation. Only recommend higher tier medications if there are compelling clinical reasons or if lower tier options are not available for the required medication class."""
+
+# Formulary filename prefix -> insurance provider
+FORMULARY_PREFIXES = {
+    "4-25 UHC": "UnitedHealthcare",
+    "4-25 BCBS": "Blue Cross Blue Shield",
+    "4-25 Cigna": "Cigna",
+    "4-25 Express": "Express Scripts",
+    "4-25 Humana": "Humana",
+    "4-25 County": "CountyCare",
+    "4-25 Meridian": "Meridian",
+    "4-25 Wellcare": "Wellcare"
+}
+
+@functools.lru_cache(maxsize=None)
+def _group_formularies(data_dir):
+    """Group the formulary files in data_dir by provider with a single directory scan"""
+    groups = {provider: [] for provider in FORMULARY_PREFIXES.values()}
+    with os.scandir(data_dir) as entries:
+        for entry in entries:
+            for prefix, provider in FORMULARY_PREFIXES.items():
+                if entry.name.startswith(prefix):
+                    groups[provider].append(entry.name)
+                    break
+    return tuple((provider, tuple(files)) for provider, files in groups.items())
+
+# Pinecone candidates fetched per context lookup, and how many survive client-side reranking
+CONTEXT_CANDIDATES = 20
+CONTEXT_MATCHES = 10
+
+# Sections every well-formed recommendation contains; a draft missing any is escalated
+_REQUIRED_SECTIONS = [re.compile(rf"\b{name}\b", re.IGNORECASE) for name in ("PRIMARY", "ALTERNATIVE", "COVERAGE")]
+
 class InhalerRecommender:
-    def __init__(self):
-        """Initialize the inhaler recommender with document processor and formulary agent"""
+    def __init__(self, model: str = "gpt-4o", fallback_model: Optional[str] = "gpt-4o"):
+        """
+        Initialize the inhaler recommender with document processor and formulary agent
+        
+        Args:
+            model: Chat model used for recommendations
+            fallback_model: Model retried once when a recommendation is missing required sections
+                (None to disable)
+        """
         self.processor = DocumentProcessor()
         self.agent = FormularyAgent()
         self.client = openai.OpenAI(api_key=OPENAI_API_KEY)
+        self.model = model
+        self.fallback_model = fallback_model
+        
+        # One Pinecone client and index handle for the recommender's lifetime
+        self._pc = Pinecone(api_key=PINECONE_API_KEY)
+        self._index = self._pc.Index("form")
+        
+        # Recent recommendations keyed by their full argument tuple, so repeat queries skip the model call
+        self._rec_cache = TTLCache(maxsize=512, ttl=600)
+        self._rec_cache_lock = threading.Lock()
+        
+        # Retrieved formulary context, one semantic cache per provider so a similar
+        # query can never return another insurer's formulary
+        self._context_caches = {}
+        self._context_caches_lock = threading.Lock()
+        
+        # Embeddings of each medication class, used to rerank retrieved context
+        self._prototypes = {}
+        self._prototypes_lock = threading.Lock()
         
         # Define medication classes
         self.medication_classes = {
@@ -51,14 +152,7 @@ class InhalerRecommender:
         
         # Map insurance providers to their formulary files
         self.insurance_formularies = {
-            "UnitedHealthcare": [f for f in os.listdir("data") if f.startswith("4-25 UHC")],
-            "Blue Cross Blue Shield": [f for f in os.listdir("data") if f.startswith("4-25 BCBS")],
-            "Cigna": [f for f in os.listdir("data") if f.startswith("4-25 Cigna")],
-            "Express Scripts": [f for f in os.listdir("data") if f.startswith("4-25 Express")],
-            "Humana": [f for f in os.listdir("data") if f.startswith("4-25 Humana")],
-            "CountyCare": [f for f in os.listdir("data") if f.startswith("4-25 County")],
-            "Meridian": [f for f in os.listdir("data") if f.startswith("4-25 Meridian")],
-            "Wellcare": [f for f in os.listdir("data") if f.startswith("4-25 Wellcare")]
+            provider: list(files) for provider, files in _group_formularies("data")
         }
     
     def get_inhaler_recommendation(self, 
@@ -82,130 +176,187 @@ class InhalerRecommender:
         Returns:
             Structured recommendation with primary and alternative options
         """
+        key = (insurance_provider, medication_class, patient_age,
+               tuple(patient_conditions or ()), device_preference, brand_preference)
+        with self._rec_cache_lock:
+            cached = self._rec_cache.get(key)
+        if cached is not None:
+            print(f"Recommendation cache hit: {insurance_provider} / {medication_class}")
+            return cached
+        print(f"Recommendation cache miss: {insurance_provider} / {medication_class}")
+        
         try:
             # Construct context for the query
             context = self._get_formulary_context(insurance_provider, medication_class)
             
-            # Build the prompt
-            prompt = f"""
-            As a pharmacy formulary specialist, provide an inhaler recommendation based on the following:
-            
-            PATIENT NEEDS:
-            - Insurance: {insurance_provider}
-            - Medication Class Needed: {medication_class}
-            """
-            
+            # Only the per-query fields go in the user message; the static instructions live in
+            # RECOMMENDATION_SYSTEM_PROMPT so every call starts with the same stable prefix
+            lines = [
+                "PATIENT NEEDS:",
+                f"- Insurance: {insurance_provider}",
+                f"- Medication Class Needed: {medication_class}",
+            ]
             if patient_age:
-                prompt += f"- Patient Age: {patient_age}\n"
-            
+                lines.append(f"- Patient Age: {patient_age}")
             if patient_conditions:
-                prompt += f"- Patient Conditions: {', '.join(patient_conditions)}\n"
-            
+                lines.append(f"- Patient Conditions: {', '.join(patient_conditions)}")
             if device_preference:
-                prompt += f"- Device Preference: {device_preference}\n"
-            
-            prompt += f"- Brand Preference: {brand_preference}\n\n"
-            
-            prompt += f"""
-            FORMULARY CONTEXT:
-            {context}
-            
-            Please provide a structured recommendation including:
-            1. PRIMARY RECOMMENDATION: Provide the best option based on the formulary with details on:
-               - Medication name (brand and generic)
-               - Form/device type
-               - Strength
-               - Formulary tier
-               - Prior authorization or step therapy requirements
-               - Quantity limits
-               - Estimated copay (if available)
-            
-            2. ALTERNATIVE OPTIONS: List 1-2 alternatives with key differences and requirements
-            
-            3. COVERAGE NOTES: Any important notes about coverage, restrictions, or special considerations
-            
-            Format your response in a clear, structured way that a healthcare provider can easily understand.
-            """
-            
-            # Define tier structure information
-            tier_structure = """
-            FORMULARY TIER STRUCTURE:
-            Tier 1: Typically includes the lowest-cost generic drugs, often with the lowest copays.
-            Tier 2: May include more expensive generic drugs, some preferred brand-name drugs, and non-preferred brand-name drugs.
-            Tier 3: Often contains preferred brand-name drugs, with some generic drugs for which there are lower-cost or over-the-counter alternatives.
-            Tier 4: May include non-preferred brand-name drugs and some higher-cost generic drugs, as well as preferred specialty drugs.
-            Tier 5: Typically reserved for specialty drugs, which are expensive medications used to treat specific conditions.
-            Tier 6: Some plans may have a Tier 6 for select medications with lower copays, often including generics and some brand-name drugs for chronic conditions.
-            """
-            
-            # Add tier structure to the prompt
-            prompt += f"\n{tier_structure}\n"
+                lines.append(f"- Device Preference: {device_preference}")
+            lines.append(f"- Brand Preference: {brand_preference}")
+            lines.append("")
+            lines.append("FORMULARY CONTEXT:")
+            lines.append(context)
             
-            # Add explicit instruction to prioritize lowest tier medications
-            prompt += "\nIMPORTANT: Always prioritize medications with the lowest tier (Tier 1 if available) as your primary recommendation. Only recommend higher tier medications if there are compelling clinical reasons or if lower tier options are not available for the required medication class.\n"
-            
-            # Generate recommendation using GPT-4o
-            response = self.client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": "You are a pharmacy formulary specialist who helps healthcare providers find the best inhaler options for their patients based on insurance coverage. You ALWAYS prioritize medications with the lowest tier (Tier 1 if available) as your primary recommendation, unless there are compelling clinical reasons to choose a higher tier option. You provide clear, structured recommendations with primary and alternative options."},
-                    {"role": "user", "content": prompt}
-                ]
-            )
-            
-            return response.choices[0].message.content
+            # Generate with the fast model; escalate once if the draft lacks the expected structure
+            messages = [
+                {"role": "system", "content": RECOMMENDATION_SYSTEM_PROMPT},
+                {"role": "user", "content": "\n".join(lines)}
+            ]
+            recommendation = self._complete(self.model, messages)
+            if not self._is_complete(recommendation) and self.fallback_model and self.fallback_model != self.model:
+                print(f"Recommendation from {self.model} missing sections; retrying with {self.fallback_model}")
+                recommendation = self._complete(self.fallback_model, messages)
+            with self._rec_cache_lock:
+                self._rec_cache[key] = recommendation
+            return recommendation
             
         except Exception as e:
             return f"Error generating recommendation: {e}"
     
+    def _complete(self, model: str, messages: List[Dict[str, str]]) -> str:
+        """Run one chat completion and return its text"""
+        response = self.client.chat.completions.create(model=model, messages=messages)
+        return response.choices[0].message.content or ""
+    
+    @staticmethod
+    def _is_complete(recommendation: str) -> bool:
+        """Check that a recommendation has its primary, alternative and coverage sections"""
+        return all(pattern.search(recommendation) for pattern in _REQUIRED_SECTIONS)
+    
     def _get_formulary_context(self, insurance_provider: str, medication_class: str) -> str:
         """Retrieve relevant formulary context from Pinecone"""
         try:
             # Construct a query that combines insurance and medication class
             query = f"{insurance_provider} formulary coverage for {medication_class}"
             
+            # Reuse context retrieved for the same provider and class. The query is a fixed
+            # template over a small closed set, so only the exact tier is used: at any useful
+            # similarity threshold "...for ICS" and "...for ICS-LABA" would share an entry
+            context_cache = self._get_context_cache(insurance_provider)
+            cached = context_cache.get_exact(query)
+            if cached is not None:
+                return cached
+            
             # Get embedding for the query
             query_embedding = self.processor.get_embedding(query)
             
-            # Query Pinecone
-            from pinecone import Pinecone
-            pc = Pinecone(api_key=PINECONE_API_KEY)
-            index = pc.Index("form")
-            
             # Filter for the specific insurance provider if possible
             filter_dict = {}
             if insurance_provider:
-                # We'll use a metadata filter if the insurance field is available
-                # This is a soft filter since not all vectors might have this metadata
-                filter_dict = {"insurance": {"$eq": insurance_provider}}
+                # Same filter as the apps, so spelling variants reach the stored insurance values
+                filter_dict = insurance_filter(insurance_provider)
+            
+            # Query Pinecone, narrowed server-side to chunks tagged with the requested class
+            vector = query_embedding.tolist()
+            med_classes = get_med_classes(medication_class or "")
+            results = None
+            if med_classes:
+                results = self._index.query(
+                    namespace="formulary",
+                    vector=vector,
+                    top_k=CONTEXT_CANDIDATES,
+                    include_values=True,
+                    include_metadata=True,
+                    filter={**filter_dict, "med_class": {"$in": med_classes}}
+                )
             
-            results = index.query(
-                namespace="formulary",
-                vector=query_embedding,
-                top_k=10,
-                include_values=False,
-                include_metadata=True,
-                filter=filter_dict
-            )
+            # Vectors ingested before classes were tagged carry no med_class, so fall back
+            if results is None or not results.matches:
+                results = self._index.query(
+                    namespace="formulary",
+                    vector=vector,
+                    top_k=CONTEXT_CANDIDATES,
+                    include_values=True,
+                    include_metadata=True,
+                    filter=filter_dict
+                )
             
-            # Format context from results
-            context = ""
-            for match in results.matches:
-                if hasattr(match, 'metadata') and match.metadata:
-                    metadata = match.metadata
-                    context += f"Source: {metadata.get('source', 'Unknown')}\n"
-                    if 'type' in metadata:
-                        context += f"Type: {metadata.get('type')}\n"
-                    if 'page' in metadata:
-                        context += f"Page: {metadata.get('page')}\n"
-                    if 'content' in metadata:
-                        context += f"Content: {metadata.get('content')}\n\n"
+            # Keep the candidates closest to both the query and the medication class itself
+            matches = self._rerank(results.matches, query_embedding, self._class_prototype(medication_class))
             
+            # Format context from results, joining the pieces once at the end
+            parts = []
+            for match in matches:
+                metadata = getattr(match, 'metadata', None)
+                if not metadata:
+                    continue
+                parts.append(f"Source: {metadata.get('source', 'Unknown')}\n")
+                if 'type' in metadata:
+                    parts.append(f"Type: {metadata.get('type')}\n")
+                if 'page' in metadata:
+                    parts.append(f"Page: {metadata.get('page')}\n")
+                if 'content' in metadata:
+                    parts.append(f"Content: {metadata.get('content')}\n\n")
+            context = "".join(parts)
+            
+            if context:
+                context_cache.put(query, None, context)
             return context
         except Exception as e:
             print(f"Error retrieving context: {e}")
             return "No relevant formulary information found. Providing general recommendations based on common formulary patterns."
 
+    def _class_prototype(self, medication_class: str) -> Optional[np.ndarray]:
+        """Embedding of a medication class described by its name and example drugs, memoized per class"""
+        with self._prototypes_lock:
+            if medication_class in self._prototypes:
+                return self._prototypes[medication_class]
+        examples = self.medication_examples.get(medication_class, [])
+        text = f"{medication_class}: {', '.join(examples)}" if examples else medication_class
+        prototype = self.processor.get_embedding(text) if text else None
+        if prototype is not None:
+            with self._prototypes_lock:
+                self._prototypes[medication_class] = prototype
+        return prototype
+    
+    @staticmethod
+    def _rerank(matches, query_embedding, prototype, keep: int = CONTEXT_MATCHES):
+        """
+        Order Pinecone matches by mean cosine similarity to the query and the class prototype
+        
+        Args:
+            matches: Pinecone matches, fetched with include_values=True
+            query_embedding: Unit-length query embedding
+            prototype: Unit-length class prototype embedding, or None to keep Pinecone's order
+            keep: Number of matches to return
+        """
+        scored = [m for m in matches if getattr(m, 'values', None)]
+        if prototype is None or len(scored) < 2:
+            return list(matches)[:keep]
+        
+        # One (N, d) @ (d, 2) product scores every candidate against both references
+        mat = np.asarray([m.values for m in scored], dtype=np.float32)
+        mat /= np.maximum(np.linalg.norm(mat, axis=1, keepdims=True), 1e-12)
+        sims = mat @ np.stack([query_embedding, prototype]).astype(np.float32).T
+        order = np.argsort(-sims.mean(axis=1), kind="stable")[:keep]
+        return [scored[i] for i in order]
+    
+    def _get_context_cache(self, insurance_provider: str) -> SemanticCache:
+        """Return the persistent context cache for a provider, creating it on first use"""
+        with self._context_caches_lock:
+            cache = self._context_caches.get(insurance_provider)
+            if cache is None:
+                os.makedirs(CONTEXT_CACHE_DIR, exist_ok=True)
+                slug = re.sub(r'[^a-z0-9]+', '_', (insurance_provider or 'any').lower()).strip('_')
+                # Exact-match only (see _get_formulary_context), so no similarity threshold
+                cache = SemanticCache(
+                    dim=1024,
+                    ttl=24 * 60 * 60,
+                    db_path=os.path.join(CONTEXT_CACHE_DIR, f"{slug}.db")
+                )
+                self._context_caches[insurance_provider] = cache
+            return cache
+
     def run_interactive_interface(self):
         """Run an interactive command-line interface for inhaler recommendations"""
         print("\n===== Respiratory Medication Formulary Assistant =====\n")
@@ -301,7 +452,62 @@ class InhalerRecommender:
                 print(f"\nError: {e}")
                 print("Let's try again.\n")
 
+    def run_batch(self, input_path: str, output_path: str = "out.jsonl", concurrency: int = 10) -> int:
+        """
+        Generate recommendations for every request in a JSONL file, without prompting
+        
+        Args:
+            input_path: JSONL file, one request per line with 'insurance' (or 'insurance_provider'),
+                'medication_class' and optionally 'patient_age', 'patient_conditions',
+                'device_preference' and 'brand_preference'
+            output_path: JSONL file written with each request plus its 'recommendation', in input order
+            concurrency: Maximum recommendations generated at once
+            
+        Returns:
+            Number of requests processed
+        """
+        with open(input_path) as f:
+            requests = [json.loads(line) for line in f if line.strip()]
+        
+        recommendations = asyncio.run(self._recommend_all(requests, concurrency))
+        
+        with open(output_path, "w") as f:
+            for request, recommendation in zip(requests, recommendations):
+                f.write(json.dumps({**request, "recommendation": recommendation}) + "\n")
+        print(f"Wrote {len(requests)} recommendations to {output_path}")
+        return len(requests)
+    
+    async def _recommend_all(self, requests: List[Dict[str, Any]], concurrency: int) -> List[str]:
+        """Run get_inhaler_recommendation for each request, at most `concurrency` at a time"""
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def recommend(request):
+            conditions = request.get("patient_conditions")
+            if isinstance(conditions, str):
+                conditions = [c.strip() for c in conditions.split(",") if c.strip()]
+            async with semaphore:
+                # The OpenAI and Pinecone clients are synchronous, so each call runs in a worker thread
+                return await asyncio.to_thread(
+                    self.get_inhaler_recommendation,
+                    insurance_provider=request.get("insurance") or request.get("insurance_provider"),
+                    medication_class=request.get("medication_class"),
+                    patient_age=request.get("patient_age"),
+                    patient_conditions=conditions or None,
+                    device_preference=request.get("device_preference"),
+                    brand_preference=request.get("brand_preference") or "generic preferred"
+                )
+        
+        return await asyncio.gather(*(recommend(request) for request in requests))
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inhaler recommendations from insurance formularies")
+    subcommands = parser.add_subparsers(dest="command")
+    batch_parser = subcommands.add_parser("batch", help="Answer every request in a JSONL file without prompting")
+    batch_parser.add_argument("input", help="JSONL file of recommendation requests")
+    batch_parser.add_argument("-o", "--output", default="out.jsonl", help="JSONL file to write recommendations to")
+    batch_parser.add_argument("-c", "--concurrency", type=int, default=10, help="Recommendations generated at once")
+    args = parser.parse_args()
+    
     # Check if environment variables are set
     if not OPENAI_API_KEY:
         print("Error: OPENAI_API_KEY not found in environment variables.")
@@ -313,6 +519,10 @@ if __name__ == "__main__":
         print("Please set this in your .env file.")
         sys.exit(1)
     
-    # Run the interface
-    recommender = InhalerRecommender()
-    recommender.run_interactive_interface()
+    # The CLI and batch runs use the cheaper tier; incomplete answers still escalate to gpt-4o
+    recommender = InhalerRecommender(model="gpt-4o-mini")
+    if args.command == "batch":
+        recommender.run_batch(args.input, args.output, args.concurrency)
+    else:
+        # Run the interface
+        recommender.run_interactive_interface()
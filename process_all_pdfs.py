@@ -6,11 +6,13 @@ Script to process all PDF files in the data directory and store their embeddings
 """
 
 import os
-import time
-from document_processor import DocumentProcessor
+import pandas as pd
+from document_processor import (
+    DocumentProcessor, get_insurance_from_filename, get_med_classes, record_processed_sources, vector_id
+)
 
-def process_pdfs_in_batches(batch_size=5, delay_between_batches=5):
-    """Process PDFs in batches with a delay between batches"""
+def process_pdfs_in_batches(poll_interval=30):
+    """Process all PDFs, embedding every text and table in a single OpenAI Batch API job"""
     processor = DocumentProcessor()
     
     # Get list of all PDF files
@@ -19,123 +21,90 @@ def process_pdfs_in_batches(batch_size=5, delay_between_batches=5):
     
     print(f"Found {total_files} PDF files to process")
     
-    # Process in batches
-    all_embeddings = []
-    for i in range(0, total_files, batch_size):
-        batch = pdf_files[i:i+batch_size]
-        batch_num = i // batch_size + 1
-        total_batches = (total_files + batch_size - 1) // batch_size
+    # Collect every embedding input up front, keyed by a batch custom_id
+    payloads = []  # (custom_id, text to embed)
+    entries = {}   # custom_id -> embedding entry without its vector
+    failed_sources = set()  # files not fully embedded; kept out of the processed ledger
+    # Extract text and tables from all files in parallel across a process pool
+    pdf_paths = [os.path.join(processor.pdf_dir, filename) for filename in pdf_files]
+    for pdf_path, text, tables in processor.extract_many(pdf_paths):
+        filename = os.path.basename(pdf_path)
+        print(f"\nProcessing {filename}...")
         
-        print(f"\n=== Processing Batch {batch_num}/{total_batches} ===")
-        print(f"Files: {batch}")
-        
-        # Process this batch
-        batch_embeddings = []
-        for filename in batch:
-            pdf_path = os.path.join(processor.pdf_dir, filename)
-            print(f"\nProcessing {filename}...")
+        try:
+            insurance = get_insurance_from_filename(filename)
             
-            try:
-                # Extract text
-                text = processor.extract_text_from_pdf(pdf_path)
-                
-                # Extract tables
-                tables = processor.extract_tables_from_pdf(pdf_path)
-                
-                # Create embeddings
-                file_embeddings = []
-                
-                # Embedding for full text
-                if text:
-                    print(f"Creating embedding for full text...")
-                    text_embedding = processor.get_embedding(text)
-                    if isinstance(text_embedding, list) and len(text_embedding) > 0:
-                        file_embeddings.append({
-                            'content': text[:1000] + '...',  # Just store preview
-                            'embedding': text_embedding,
-                            'metadata': {'source': filename, 'type': 'full_text', 'insurance': get_insurance_from_filename(filename)}
-                        })
-                
-                # Embeddings for tables
-                for i, table in enumerate(tables):
-                    if isinstance(table['data'], pd.DataFrame) and not table['data'].empty:
-                        print(f"Creating embedding for table {i+1}...")
-                        table_str = table['data'].to_string()
-                        table_embedding = processor.get_embedding(table_str)
-                        if isinstance(table_embedding, list) and len(table_embedding) > 0:
-                            file_embeddings.append({
-                                'content': f"Table from page {table['page']}:\n{table_str[:500]}...",
-                                'embedding': table_embedding,
-                                'metadata': {
-                                    'source': filename,
-                                    'type': 'table',
-                                    'page': table['page'],
-                                    'insurance': get_insurance_from_filename(filename)
-                                }
-                            })
-                
-                batch_embeddings.extend(file_embeddings)
-                print(f"Created {len(file_embeddings)} embeddings for {filename}")
-                
-            except Exception as e:
-                print(f"Error processing {filename}: {e}")
-        
-        # Store batch embeddings in Pinecone
-        if batch_embeddings:
-            print(f"\nStoring {len(batch_embeddings)} embeddings from batch {batch_num} in Pinecone...")
-            success = processor.store_in_pinecone(batch_embeddings)
-            if success:
-                print(f"Successfully stored batch {batch_num} embeddings in Pinecone")
-                all_embeddings.extend(batch_embeddings)
-            else:
-                print(f"Failed to store batch {batch_num} embeddings in Pinecone")
-        
-        # Delay between batches to avoid rate limits
-        if i + batch_size < total_files:
-            print(f"\nWaiting {delay_between_batches} seconds before processing next batch...")
-            time.sleep(delay_between_batches)
+            # Text, as overlapping token windows so each embedding covers a focused span
+            if text:
+                for chunk_idx, chunk in enumerate(processor.chunk_text(text)):
+                    metadata = {
+                        'source': filename,
+                        'type': 'text_chunk',
+                        'chunk_idx': chunk_idx,
+                        'insurance': insurance,
+                        'med_class': get_med_classes(chunk)
+                    }
+                    custom_id = vector_id(metadata)  # also the Pinecone vector ID
+                    payloads.append((custom_id, chunk))
+                    entries[custom_id] = {'content': chunk, 'metadata': metadata}
+            
+            # Tables
+            for table in tables:
+                if isinstance(table['data'], pd.DataFrame) and not table['data'].empty:
+                    table_str = table['data'].iloc[:200, :40].to_csv(index=False)
+                    metadata = {
+                        'source': filename,
+                        'type': 'table',
+                        'page': table['page'],
+                        'table_num': table['table_num'],
+                        'insurance': insurance,
+                        'med_class': get_med_classes(table_str)
+                    }
+                    custom_id = vector_id(metadata)  # also the Pinecone vector ID
+                    payloads.append((custom_id, table_str))
+                    entries[custom_id] = {
+                        'content': f"Table from page {table['page']}:\n{table_str[:500]}...",
+                        'metadata': metadata
+                    }
+            
+        except Exception as e:
+            print(f"Error processing {filename}: {e}")
+            failed_sources.add(filename)
+    
+    # One Batch API job for everything, then one bulk upsert
+    print(f"\nSubmitting {len(payloads)} texts for embedding...")
+    vectors = processor.embed_with_batch_api(payloads, poll_interval=poll_interval)
+    all_embeddings = [
+        {**entries[custom_id], 'embedding': vectors[custom_id]}
+        for custom_id, _ in payloads if custom_id in vectors
+    ]
+    print(f"Created {len(all_embeddings)} embeddings")
+    
+    # A file whose inputs errored or never came back is only partly embedded, so it must be retried
+    missing = [custom_id for custom_id, _ in payloads if custom_id not in vectors]
+    failed_sources.update(entries[custom_id]['metadata']['source'] for custom_id in missing)
+    if missing:
+        print(f"{len(missing)} embeddings failed or are missing; {len(failed_sources)} files will be retried")
+    
+    if all_embeddings:
+        print(f"\nStoring {len(all_embeddings)} embeddings in Pinecone...")
+        if processor.store_in_pinecone(all_embeddings):
+            print("Successfully stored embeddings in Pinecone")
+            record_processed_sources({entry['metadata']['source'] for entry in all_embeddings} - failed_sources)
+        else:
+            print("Failed to store embeddings in Pinecone")
+            all_embeddings = []
     
     print(f"\n=== Processing Complete ===")
     print(f"Total embeddings created and stored: {len(all_embeddings)}")
     return all_embeddings
 
-def get_insurance_from_filename(filename):
-    """Extract insurance provider from filename"""
-    # Common insurance providers in the filenames
-    providers = {
-        "UHC": "UnitedHealthcare",
-        "BCBS": "Blue Cross Blue Shield",
-        "Cigna": "Cigna",
-        "Express Scripts": "Express Scripts",
-        "Humana": "Humana",
-        "Meridian": "Meridian",
-        "Wellcare": "Wellcare",
-        "County Care": "County Care"
-    }
-    
-    for key, value in providers.items():
-        if key in filename:
-            # Check for specific plan types
-            if "HMO" in filename:
-                return f"{value} HMO"
-            elif "PPO" in filename:
-                return f"{value} PPO"
-            elif "Medicare" in filename:
-                return f"{value} Medicare"
-            else:
-                return value
-    
-    return "Unknown Insurance"
-
 if __name__ == "__main__":
-    import pandas as pd
-    
     print("=== Processing All Formulary PDFs ===")
     print("This script will process all PDF files in the data directory and store their embeddings in Pinecone.")
-    print("Processing will be done in batches to avoid overwhelming the system.\n")
+    print("Embeddings are created with one OpenAI Batch API job, which can take a while to complete.\n")
     
-    # Process PDFs in batches of 5 with a 5-second delay between batches
-    all_embeddings = process_pdfs_in_batches(batch_size=5, delay_between_batches=5)
+    all_embeddings = process_pdfs_in_batches()
     
     print("\nAll PDFs have been processed and their embeddings stored in Pinecone.")
     print("You can now use the query interface to search for medications across all formularies.")
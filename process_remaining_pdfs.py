@@ -6,22 +6,37 @@ Script to process only the remaining unprocessed PDF files and store their embed
 """
 
 import os
-import time
+import asyncio
 import pandas as pd
-from document_processor import DocumentProcessor
+from document_processor import (
+    DocumentProcessor, get_insurance_from_filename, get_med_classes, open_pinecone_index,
+    read_processed_sources, record_processed_sources, vector_id
+)
 
-def process_remaining_pdfs(batch_size=3, delay_between_batches=5):
-    """Process only the remaining unprocessed PDF files"""
+def process_remaining_pdfs(batch_size=64, concurrency=4, upsert_batch_size=100):
+    """
+    Process only the remaining unprocessed PDF files
+    
+    Args:
+        batch_size: Maximum texts per embedding request
+        concurrency: Number of embedding requests in flight at once
+        upsert_batch_size: Vectors per Pinecone upsert
+    """
     processor = DocumentProcessor()
     
-    # Get list of all PDF files
-    all_pdf_files = [f for f in os.listdir(processor.pdf_dir) if f.endswith('.pdf')]
+    # One index handle, shared by the processed-files check and every upsert
+    try:
+        index = open_pinecone_index("form")
+    except Exception as e:
+        print(f"Error connecting to Pinecone: {e}")
+        return []
     
     # Get list of already processed files from Pinecone
-    processed_files = get_processed_files()
+    pdf_files = sorted(f for f in os.listdir(processor.pdf_dir) if f.endswith('.pdf'))
+    processed_files = frozenset(get_processed_files(index, pdf_files))
     
-    # Determine which files still need processing
-    remaining_files = list(set(all_pdf_files) - set(processed_files))
+    # PDFs that still need processing, in a stable order
+    remaining_files = [f for f in pdf_files if f not in processed_files]
     
     if not remaining_files:
         print("All PDF files have already been processed!")
@@ -29,161 +44,223 @@ def process_remaining_pdfs(batch_size=3, delay_between_batches=5):
     
     total_files = len(remaining_files)
     print(f"Found {total_files} PDF files that still need processing:")
-    for i, filename in enumerate(sorted(remaining_files), 1):
+    for i, filename in enumerate(remaining_files, 1):
         print(f"{i}. {filename}")
     
-    # Process in batches
-    all_embeddings = []
-    for i in range(0, total_files, batch_size):
-        batch = remaining_files[i:i+batch_size]
-        batch_num = i // batch_size + 1
-        total_batches = (total_files + batch_size - 1) // batch_size
-        
-        print(f"\n=== Processing Batch {batch_num}/{total_batches} ===")
-        print(f"Files: {batch}")
-        
-        # Process this batch
-        batch_embeddings = []
-        for filename in batch:
-            pdf_path = os.path.join(processor.pdf_dir, filename)
+    # Extraction, embedding and upserts overlap instead of running one after another
+    pdf_paths = [os.path.join(processor.pdf_dir, filename) for filename in remaining_files]
+    all_embeddings = asyncio.run(_run_pipeline(
+        processor, index, pdf_paths, batch_size, concurrency, upsert_batch_size
+    ))
+    
+    print(f"\n=== Processing Complete ===")
+    print(f"Total embeddings created and stored: {len(all_embeddings)}")
+    return all_embeddings
+
+def build_payloads(processor, filename, text, tables):
+    """Turn one extracted PDF into (text to embed, embedding entry without its vector) pairs"""
+    insurance = get_insurance_from_filename(filename)
+    payloads = []
+    
+    # Text, as overlapping token windows so each embedding covers a focused span
+    if text:
+        for chunk_idx, chunk in enumerate(processor.chunk_text(text)):
+            payloads.append((chunk, {
+                'content': chunk,
+                'metadata': {
+                    'source': filename,
+                    'type': 'text_chunk',
+                    'chunk_idx': chunk_idx,
+                    'insurance': insurance,
+                    'med_class': get_med_classes(chunk)
+                }
+            }))
+    
+    # Tables
+    for table in tables:
+        if isinstance(table['data'], pd.DataFrame) and not table['data'].empty:
+            table_str = table['data'].iloc[:200, :40].to_csv(index=False)
+            payloads.append((table_str, {
+                'content': f"Table from page {table['page']}:\n{table_str[:500]}...",
+                'metadata': {
+                    'source': filename,
+                    'type': 'table',
+                    'page': table['page'],
+                    'table_num': table['table_num'],
+                    'insurance': insurance,
+                    'med_class': get_med_classes(table_str)
+                }
+            }))
+    
+    return payloads
+
+async def _run_pipeline(processor, index, pdf_paths, batch_size, concurrency, upsert_batch_size):
+    """Extract, embed and upsert as three overlapping stages joined by bounded queues"""
+    loop = asyncio.get_running_loop()
+    embed_queue = asyncio.Queue(maxsize=8 * batch_size)  # payloads waiting to be embedded
+    upsert_queue = asyncio.Queue(maxsize=8)              # lists of embedded entries waiting to be stored
+    sources = set()
+    failed_sources = set()
+    stored = []
+    
+    def extract():
+        # Runs in a worker thread; extract_many fans parsing out over a process pool
+        for pdf_path, text, tables in processor.extract_many(pdf_paths):
+            filename = os.path.basename(pdf_path)
             print(f"\nProcessing {filename}...")
-            
             try:
-                # Extract text
-                text = processor.extract_text_from_pdf(pdf_path)
-                
-                # Extract tables
-                tables = processor.extract_tables_from_pdf(pdf_path)
-                
-                # Create embeddings
-                file_embeddings = []
-                
-                # Embedding for full text
-                if text:
-                    print(f"Creating embedding for full text...")
-                    text_embedding = processor.get_embedding(text)
-                    if isinstance(text_embedding, list) and len(text_embedding) > 0:
-                        file_embeddings.append({
-                            'content': text[:1000] + '...',  # Just store preview
-                            'embedding': text_embedding,
-                            'metadata': {'source': filename, 'type': 'full_text', 'insurance': get_insurance_from_filename(filename)}
-                        })
-                
-                # Embeddings for tables
-                for i, table in enumerate(tables):
-                    if isinstance(table['data'], pd.DataFrame) and not table['data'].empty:
-                        print(f"Creating embedding for table {i+1}...")
-                        table_str = table['data'].to_string()
-                        table_embedding = processor.get_embedding(table_str)
-                        if isinstance(table_embedding, list) and len(table_embedding) > 0:
-                            file_embeddings.append({
-                                'content': f"Table from page {table['page']}:\n{table_str[:500]}...",
-                                'embedding': table_embedding,
-                                'metadata': {
-                                    'source': filename,
-                                    'type': 'table',
-                                    'page': table['page'],
-                                    'insurance': get_insurance_from_filename(filename)
-                                }
-                            })
-                
-                batch_embeddings.extend(file_embeddings)
-                print(f"Created {len(file_embeddings)} embeddings for {filename}")
-                
+                payloads = build_payloads(processor, filename, text, tables)
             except Exception as e:
                 print(f"Error processing {filename}: {e}")
-        
-        # Store batch embeddings in Pinecone
-        if batch_embeddings:
-            print(f"\nStoring {len(batch_embeddings)} embeddings from batch {batch_num} in Pinecone...")
-            success = processor.store_in_pinecone(batch_embeddings)
-            if success:
-                print(f"Successfully stored batch {batch_num} embeddings in Pinecone")
-                all_embeddings.extend(batch_embeddings)
-            else:
-                print(f"Failed to store batch {batch_num} embeddings in Pinecone")
-        
-        # Delay between batches to avoid rate limits
-        if i + batch_size < total_files:
-            print(f"\nWaiting {delay_between_batches} seconds before processing next batch...")
-            time.sleep(delay_between_batches)
+                continue
+            if payloads:
+                sources.add(filename)
+            for payload in payloads:
+                asyncio.run_coroutine_threadsafe(embed_queue.put(payload), loop).result()
     
-    print(f"\n=== Processing Complete ===")
-    print(f"Total embeddings created and stored: {len(all_embeddings)}")
-    return all_embeddings
+    async def extract_stage():
+        try:
+            await asyncio.to_thread(extract)
+        finally:
+            # One end marker per embedder
+            for _ in range(concurrency):
+                await embed_queue.put(None)
+    
+    async def embed_worker():
+        finished = False
+        while not finished:
+            payload = await embed_queue.get()
+            if payload is None:
+                return
+            
+            # Take whatever else is already waiting, up to one request's worth
+            batch = [payload]
+            while len(batch) < batch_size and not embed_queue.empty():
+                payload = embed_queue.get_nowait()
+                if payload is None:
+                    finished = True
+                    break
+                batch.append(payload)
+            
+            vectors = await processor.get_embeddings_async(
+                [text for text, _ in batch], batch_size=batch_size, client=client
+            )
+            entries = []
+            for (_, entry), embedding in zip(batch, vectors):
+                if embedding is None:
+                    failed_sources.add(entry['metadata']['source'])
+                else:
+                    entries.append({**entry, 'embedding': embedding})
+            if entries:
+                await upsert_queue.put(entries)
+    
+    async def upsert(entries):
+        if await asyncio.to_thread(processor.store_in_pinecone, entries, index=index):
+            stored.extend(entries)
+        else:
+            failed_sources.update(entry['metadata']['source'] for entry in entries)
+    
+    async def upsert_stage():
+        pending = []
+        while True:
+            entries = await upsert_queue.get()
+            if entries is None:
+                break
+            pending.extend(entries)
+            while len(pending) >= upsert_batch_size:
+                await upsert(pending[:upsert_batch_size])
+                pending = pending[upsert_batch_size:]
+        if pending:
+            await upsert(pending)
+    
+    # One async OpenAI client (and connection pool) for every embedder, closed when the run ends
+    async with processor.open_async_client() as client:
+        embedders = [asyncio.create_task(embed_worker()) for _ in range(concurrency)]
+        upserter = asyncio.create_task(upsert_stage())
+        await extract_stage()
+        await asyncio.gather(*embedders)
+        await upsert_queue.put(None)
+        await upserter
+    
+    # Only files whose every vector made it into Pinecone count as processed
+    if sources - failed_sources:
+        record_processed_sources(sources - failed_sources)
+    return stored
+
+# Entry types whose first vector ("<source>::<type>::0", see vector_id) usually marks a file as stored
+FIRST_VECTOR_TYPES = ("text_chunk", "full_text")
+
+# ID prefixes listed for files without a first vector: the current "<source>::" scheme and
+# the older "<source>_<type>_<n>" one, still present in indexes built before vector_id
+LISTED_ID_PREFIXES = ("::", "_")
 
-def get_processed_files():
-    """Get list of already processed files from Pinecone"""
+def get_processed_files(index=None, filenames=None):
+    """
+    Get list of already processed files from the local ledger, falling back to Pinecone
+    
+    Args:
+        index: Optional open Pinecone index to reuse instead of connecting again
+        filenames: Optional candidate PDF filenames, checked by fetching their deterministic
+            vector IDs instead of scanning the whole namespace
+    """
+    processed = read_processed_sources()
+    if processed is not None:
+        return list(processed)
+    
     try:
-        from pinecone import Pinecone
-        import os
-        from dotenv import load_dotenv
+        from check_pinecone_status import list_indexed_sources
         
-        # Load environment variables
-        load_dotenv()
-        PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
+        if index is None:
+            # Connect to the 'form' index
+            index = open_pinecone_index("form")
         
-        # Initialize Pinecone
-        pc = Pinecone(api_key=PINECONE_API_KEY)
-        
-        # Connect to the 'form' index
-        index = pc.Index("form")
-        
-        # Create a dummy query to get metadata
-        query_embedding = [0.1] * 1024
-        results = index.query(
-            namespace="formulary",
-            vector=query_embedding,
-            top_k=1000,  # Get a large number to see more sources
-            include_metadata=True
-        )
-        
-        # Extract unique source files
-        sources = set()
-        for match in results.matches:
-            if hasattr(match, 'metadata') and match.metadata and 'source' in match.metadata:
-                sources.add(match.metadata['source'])
+        # No ledger yet: look up each file's first vector directly, and only page through
+        # every vector ID for indexes written before IDs were deterministic
+        sources = fetch_stored_sources(index, filenames) if filenames else set()
+        if not sources:
+            sources = list_indexed_sources(index, namespace="formulary")
+        if sources:
+            record_processed_sources(sources)
         
         return list(sources)
     except Exception as e:
         print(f"Error getting processed files: {e}")
         return []
 
-def get_insurance_from_filename(filename):
-    """Extract insurance provider from filename"""
-    # Common insurance providers in the filenames
-    providers = {
-        "UHC": "UnitedHealthcare",
-        "BCBS": "Blue Cross Blue Shield",
-        "Cigna": "Cigna",
-        "Express Scripts": "Express Scripts",
-        "Humana": "Humana",
-        "Meridian": "Meridian",
-        "Wellcare": "Wellcare",
-        "County Care": "County Care"
+def fetch_stored_sources(index, filenames, namespace="formulary", batch_size=100):
+    """
+    Return the filenames with vectors in the index
+    
+    The usual first vector IDs are fetched in batches; files without one (tables only, text
+    from another chunker, or vectors stored under the older "<source>_<type>_<n>" IDs) are
+    checked with a one-ID listing of each ID prefix.
+    """
+    ids = {
+        vector_id({'source': filename, 'type': kind}): filename
+        for filename in filenames for kind in FIRST_VECTOR_TYPES
     }
+    id_list = list(ids)
+    sources = set()
+    for start in range(0, len(id_list), batch_size):
+        fetched = index.fetch(ids=id_list[start:start + batch_size], namespace=namespace)
+        sources.update(ids[fetched_id] for fetched_id in fetched.vectors)
     
-    for key, value in providers.items():
-        if key in filename:
-            # Check for specific plan types
-            if "HMO" in filename:
-                return f"{value} HMO"
-            elif "PPO" in filename:
-                return f"{value} PPO"
-            elif "Medicare" in filename:
-                return f"{value} Medicare"
-            else:
-                return value
-    
-    return "Unknown Insurance"
+    for filename in filenames:
+        for prefix in LISTED_ID_PREFIXES:
+            if filename in sources:
+                break
+            for page in index.list(prefix=f"{filename}{prefix}", namespace=namespace, limit=1):
+                if page:
+                    sources.add(filename)
+                break
+    return sources
 
 if __name__ == "__main__":
     print("=== Processing Remaining Formulary PDFs ===")
     print("This script will process only the PDF files that haven't been processed yet.")
-    print("Processing will be done in batches to avoid overwhelming the system.\n")
+    print("Embedding requests run concurrently, with retries if the API rate-limits.\n")
     
-    # Process remaining PDFs in batches of 3 with a 5-second delay between batches
-    all_embeddings = process_remaining_pdfs(batch_size=3, delay_between_batches=5)
+    all_embeddings = process_remaining_pdfs()
     
     print("\nAll remaining PDFs have been processed and their embeddings stored in Pinecone.")
     print("You can now deploy your formulary agent to Streamlit for nurse access.")
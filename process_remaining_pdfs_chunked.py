@@ -7,221 +7,239 @@ Script to process remaining PDF files with text chunking to handle large documen
 
 import os
 import time
+import asyncio
+import bisect
+import contextlib
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
-from document_processor import DocumentProcessor
+from document_processor import (
+    DocumentProcessor, _embedding_encoding, get_insurance_from_filename, get_med_classes, open_pinecone_index,
+    record_processed_sources
+)
+from process_remaining_pdfs import get_processed_files
 
-def process_remaining_pdfs(batch_size=3, delay_between_batches=5, chunk_size=4000):
-    """Process remaining PDF files with text chunking"""
+def process_remaining_pdfs(batch_size=3, delay_between_batches=5, chunk_tokens=1000):
+    """
+    Process remaining PDF files with text chunking, returning the number of embeddings stored
+    
+    Raises RuntimeError after the last batch if any upsert failed; those files stay out of the ledger.
+    """
     processor = DocumentProcessor()
     
-    # Get list of all PDF files
-    all_pdf_files = [f for f in os.listdir(processor.pdf_dir) if f.endswith('.pdf')]
+    # One index handle, shared by the processed-files check and every upsert
+    try:
+        index = open_pinecone_index("form")
+    except Exception as e:
+        print(f"Error connecting to Pinecone: {e}")
+        return 0
     
-    # Get list of already processed files from Pinecone
-    processed_files = get_processed_files()
+    # Get list of already processed files (ledger first, then Pinecone ID lookups)
+    pdf_files = sorted(f for f in os.listdir(processor.pdf_dir) if f.endswith('.pdf'))
+    processed_files = frozenset(get_processed_files(index, pdf_files))
     
-    # Determine which files still need processing
-    remaining_files = list(set(all_pdf_files) - set(processed_files))
+    # PDFs that still need processing, in a stable order
+    remaining_files = [f for f in pdf_files if f not in processed_files]
     
     if not remaining_files:
         print("All PDF files have already been processed!")
-        return []
+        return 0
     
     total_files = len(remaining_files)
     print(f"Found {total_files} PDF files that still need processing:")
-    for i, filename in enumerate(sorted(remaining_files), 1):
+    for i, filename in enumerate(remaining_files, 1):
         print(f"{i}. {filename}")
     
-    # Process in batches
-    all_embeddings = []
-    for i in range(0, total_files, batch_size):
-        batch = remaining_files[i:i+batch_size]
-        batch_num = i // batch_size + 1
-        total_batches = (total_files + batch_size - 1) // batch_size
-        
-        print(f"\n=== Processing Batch {batch_num}/{total_batches} ===")
-        print(f"Files: {batch}")
-        
-        # Process this batch
-        batch_embeddings = []
-        for filename in batch:
-            pdf_path = os.path.join(processor.pdf_dir, filename)
-            print(f"\nProcessing {filename}...")
+    # Parse every remaining PDF across a process pool; later files are parsed while
+    # earlier batches are being embedded and stored
+    pdf_paths = [os.path.join(processor.pdf_dir, filename) for filename in remaining_files]
+    extracted = processor.extract_many(pdf_paths)
+    
+    # Process in batches. Each batch's upsert runs in the background while the next batch
+    # is embedded, and delay_between_batches only paces the embedding requests.
+    total_stored = 0  # vectors are dropped once stored; only the count is kept
+    upload = None  # (batch_num, embeddings, failed sources, future) for the upsert in flight
+    unstored_files = set()  # files from batches whose upsert failed
+    next_embed_at = 0.0
+    with ThreadPoolExecutor(max_workers=1) as upload_pool, _batch_embedder(processor, concurrency=8) as embed:
+        for i in range(0, total_files, batch_size):
+            batch = remaining_files[i:i+batch_size]
+            batch_num = i // batch_size + 1
+            total_batches = (total_files + batch_size - 1) // batch_size
             
-            try:
-                # Extract text
-                text = processor.extract_text_from_pdf(pdf_path)
-                
-                # Extract tables
-                tables = processor.extract_tables_from_pdf(pdf_path)
-                
-                # Create embeddings
-                file_embeddings = []
+            print(f"\n=== Processing Batch {batch_num}/{total_batches} ===")
+            print(f"Files: {batch}")
+            
+            # Collect every text chunk and table in this batch, then embed them together
+            pending = []  # (text to embed, embedding entry without its vector)
+            for pdf_path, text, tables in itertools.islice(extracted, len(batch)):
+                filename = os.path.basename(pdf_path)
+                print(f"\nProcessing {filename}...")
                 
-                # Chunk the text to avoid token limits
-                if text:
-                    chunks = chunk_text(text, chunk_size)
-                    print(f"Split text into {len(chunks)} chunks")
+                try:
+                    file_count = len(pending)
+                    # Loop-invariant metadata, built once per file
+                    base_metadata = {'source': filename, 'insurance': get_insurance_from_filename(filename)}
                     
-                    for chunk_idx, chunk in enumerate(chunks):
-                        print(f"Creating embedding for text chunk {chunk_idx+1}/{len(chunks)}...")
-                        try:
-                            chunk_embedding = processor.get_embedding(chunk)
-                            if isinstance(chunk_embedding, list) and len(chunk_embedding) > 0:
-                                file_embeddings.append({
-                                    'content': chunk[:500] + '...',  # Just store preview
-                                    'embedding': chunk_embedding,
-                                    'metadata': {
-                                        'source': filename, 
-                                        'type': 'text_chunk', 
-                                        'chunk_idx': chunk_idx,
-                                        'insurance': get_insurance_from_filename(filename)
-                                    }
-                                })
-                        except Exception as e:
-                            print(f"Error creating embedding for chunk {chunk_idx+1}: {e}")
-                
-                # Embeddings for tables
-                for i, table in enumerate(tables):
-                    if isinstance(table.get('data'), pd.DataFrame) and not table['data'].empty:
-                        print(f"Creating embedding for table {i+1}...")
-                        table_str = table['data'].to_string()
-                        try:
-                            table_embedding = processor.get_embedding(table_str)
-                            if isinstance(table_embedding, list) and len(table_embedding) > 0:
-                                file_embeddings.append({
-                                    'content': f"Table from page {table['page']}:\n{table_str[:500]}...",
-                                    'embedding': table_embedding,
-                                    'metadata': {
-                                        'source': filename,
-                                        'type': 'table',
-                                        'page': table['page'],
-                                        'insurance': get_insurance_from_filename(filename)
-                                    }
-                                })
-                        except Exception as e:
-                            print(f"Error creating embedding for table {i+1}: {e}")
-                
-                batch_embeddings.extend(file_embeddings)
-                print(f"Created {len(file_embeddings)} embeddings for {filename}")
-                
-            except Exception as e:
-                print(f"Error processing {filename}: {e}")
-        
-        # Store batch embeddings in Pinecone
-        if batch_embeddings:
-            print(f"\nStoring {len(batch_embeddings)} embeddings from batch {batch_num} in Pinecone...")
-            success = processor.store_in_pinecone(batch_embeddings)
-            if success:
-                print(f"Successfully stored batch {batch_num} embeddings in Pinecone")
-                all_embeddings.extend(batch_embeddings)
-            else:
-                print(f"Failed to store batch {batch_num} embeddings in Pinecone")
+                    # Chunk the text to avoid token limits. These windows differ from
+                    # DocumentProcessor.chunk_text's, so they get their own type (and vector IDs)
+                    if text:
+                        chunk_type = f"text_chunk_{chunk_tokens}"
+                        chunks = chunk_text(text, chunk_tokens)
+                        print(f"Split text into {len(chunks)} chunks")
+                        
+                        for chunk_idx, chunk in enumerate(chunks):
+                            pending.append((chunk, {
+                                'content': chunk[:500] + '...',  # Just store preview
+                                'metadata': {**base_metadata, 'type': chunk_type, 'chunk_idx': chunk_idx,
+                                             'med_class': get_med_classes(chunk)}
+                            }))
+                    
+                    # Tables
+                    for table in tables:
+                        if isinstance(table.get('data'), pd.DataFrame) and not table['data'].empty:
+                            table_str = table['data'].iloc[:200, :40].to_csv(index=False)
+                            pending.append((table_str, {
+                                'content': f"Table from page {table['page']}:\n{table_str[:500]}...",
+                                'metadata': {**base_metadata, 'type': 'table', 'page': table['page'],
+                                             'table_num': table['table_num'],
+                                             'med_class': get_med_classes(table_str)}
+                            }))
+                    
+                    print(f"Queued {len(pending) - file_count} items for embedding from {filename}")
+                    
+                except Exception as e:
+                    print(f"Error processing {filename}: {e}")
+            
+            # Space embedding requests to avoid rate limits; parsing and the previous upsert keep going
+            wait = next_embed_at - time.monotonic()
+            if wait > 0:
+                print(f"\nWaiting {wait:.1f} seconds before embedding batch {batch_num}...")
+                time.sleep(wait)
+            next_embed_at = time.monotonic() + delay_between_batches
+            
+            # Batched embeddings requests (up to 96 inputs each), with up to 8 in flight at once
+            batch_embeddings = []
+            failed_sources = set()
+            if pending:
+                print(f"\nCreating {len(pending)} embeddings for batch {batch_num}...")
+                vectors = embed([item_text for item_text, _ in pending])
+                for (_, entry), embedding in zip(pending, vectors):
+                    if embedding is not None:
+                        batch_embeddings.append({**entry, 'embedding': embedding})
+                    else:
+                        failed_sources.add(entry['metadata']['source'])
+            
+            # Store batch embeddings in Pinecone, one upsert in flight at a time
+            if upload is not None:
+                total_stored += _finish_upload(*upload, unstored_files)
+                upload = None
+            if batch_embeddings:
+                print(f"\nStoring {len(batch_embeddings)} embeddings from batch {batch_num} in Pinecone...")
+                future = upload_pool.submit(processor.store_in_pinecone, batch_embeddings, index=index)
+                upload = (batch_num, batch_embeddings, failed_sources, future)
         
-        # Delay between batches to avoid rate limits
-        if i + batch_size < total_files:
-            print(f"\nWaiting {delay_between_batches} seconds before processing next batch...")
-            time.sleep(delay_between_batches)
+        if upload is not None:
+            total_stored += _finish_upload(*upload, unstored_files)
     
     print(f"\n=== Processing Complete ===")
-    print(f"Total embeddings created and stored: {len(all_embeddings)}")
-    return all_embeddings
+    print(f"Total embeddings created and stored: {total_stored}")
+    if unstored_files:
+        raise RuntimeError(f"Failed to store embeddings in Pinecone for {len(unstored_files)} files; "
+                           f"rerun to retry: {sorted(unstored_files)}")
+    return total_stored
+
+@contextlib.contextmanager
+def _batch_embedder(processor, concurrency=8):
+    """Yield a function that embeds one batch's texts; every call shares one event loop and AsyncOpenAI client"""
+    loop = asyncio.new_event_loop()
+    client = processor.open_async_client()
+    try:
+        yield lambda texts: loop.run_until_complete(
+            processor.get_embeddings_async(texts, concurrency=concurrency, client=client)
+        )
+    finally:
+        loop.run_until_complete(client.close())
+        loop.close()
 
-def chunk_text(text, chunk_size=4000, overlap=200):
-    """Split text into chunks of specified size with overlap"""
+def _finish_upload(batch_num, batch_embeddings, failed_sources, future, unstored_files):
+    """
+    Wait for a background upsert, record its fully stored files, and return how many vectors it stored
+    
+    A failed upsert (False or an exception from the future) records nothing; its files are
+    added to unstored_files so the run can fail once every other batch has finished.
+    """
+    batch_sources = {entry['metadata']['source'] for entry in batch_embeddings}
+    try:
+        stored = future.result()
+    except Exception as e:
+        print(f"Error storing batch {batch_num} embeddings: {e}")
+        stored = False
+    if not stored:
+        print(f"Failed to store batch {batch_num} embeddings in Pinecone")
+        unstored_files.update(batch_sources)
+        return 0
+    print(f"Successfully stored batch {batch_num} embeddings in Pinecone")
+    
+    # Files with every vector stored are skipped on the next run
+    stored_sources = batch_sources - failed_sources
+    if stored_sources:
+        record_processed_sources(stored_sources)
+    return len(batch_embeddings)
+
+# Preferred chunk break points, best first
+_BREAK_CHARS = ('. ', '\n', ' ')
+
+def chunk_text(text, max_tokens=1000, overlap=200):
+    """
+    Split text into chunks of about max_tokens embedding tokens, overlapping by `overlap` characters
+    
+    Each chunk is as long as the token budget allows, then trimmed back to the last sentence
+    end, newline, or space, so chunk size tracks what the embedding model actually counts.
+    """
+    if not text:
+        return []
+    encoding = _embedding_encoding()
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return [text]
+    
+    # Character offset at which each token starts; the text is tokenized once and every
+    # window boundary is a binary search over these offsets
+    _, offsets = encoding.decode_with_offsets(tokens)
+    
     chunks = []
     start = 0
     text_len = len(text)
     
     while start < text_len:
-        end = min(start + chunk_size, text_len)
-        # If this is not the last chunk, try to find a good break point
-        if end < text_len:
-            # Try to find a period, newline, or space to break at
-            for char in ['. ', '\n', ' ']:
+        first = bisect.bisect_left(offsets, start)
+        if first + max_tokens >= len(offsets):
+            end = text_len
+        else:
+            # Largest window holding max_tokens tokens, ended at a good break point if one
+            # leaves room for the overlap
+            end = offsets[first + max_tokens]
+            for char in _BREAK_CHARS:
                 pos = text.rfind(char, start, end)
-                if pos != -1:
+                if pos + 1 - overlap > start:
                     end = pos + 1  # Include the breaking character
                     break
         
         chunks.append(text[start:end])
-        start = end - overlap if end < text_len else text_len
+        # Overlap with the previous chunk, but by never more than half of it
+        start = max(end - overlap, (start + end + 1) // 2) if end < text_len else text_len
     
     return chunks
 
-def get_processed_files():
-    """Get list of already processed files from Pinecone"""
-    try:
-        from pinecone import Pinecone
-        import os
-        from dotenv import load_dotenv
-        
-        # Load environment variables
-        load_dotenv()
-        PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
-        
-        # Initialize Pinecone
-        pc = Pinecone(api_key=PINECONE_API_KEY)
-        
-        # Connect to the 'form' index
-        index = pc.Index("form")
-        
-        # Create a dummy query to get metadata
-        query_embedding = [0.1] * 1024
-        results = index.query(
-            namespace="formulary",
-            vector=query_embedding,
-            top_k=1000,  # Get a large number to see more sources
-            include_metadata=True
-        )
-        
-        # Extract unique source files
-        sources = set()
-        for match in results.matches:
-            if hasattr(match, 'metadata') and match.metadata and 'source' in match.metadata:
-                sources.add(match.metadata['source'])
-        
-        return list(sources)
-    except Exception as e:
-        print(f"Error getting processed files: {e}")
-        return []
-
-def get_insurance_from_filename(filename):
-    """Extract insurance provider from filename"""
-    # Common insurance providers in the filenames
-    providers = {
-        "UHC": "UnitedHealthcare",
-        "BCBS": "Blue Cross Blue Shield",
-        "Cigna": "Cigna",
-        "Express Scripts": "Express Scripts",
-        "Humana": "Humana",
-        "Meridian": "Meridian",
-        "Wellcare": "Wellcare",
-        "County Care": "County Care"
-    }
-    
-    for key, value in providers.items():
-        if key in filename:
-            # Check for specific plan types
-            if "HMO" in filename:
-                return f"{value} HMO"
-            elif "PPO" in filename:
-                return f"{value} PPO"
-            elif "Medicare" in filename:
-                return f"{value} Medicare"
-            else:
-                return value
-    
-    return "Unknown Insurance"
-
 if __name__ == "__main__":
     print("=== Processing Remaining Formulary PDFs with Chunking ===")
     print("This script will process the remaining PDF files with text chunking to handle large documents.")
     print("Processing will be done in batches to avoid overwhelming the system.\n")
     
-    # Process remaining PDFs in batches of 3 with a 5-second delay between batches
-    # Using 4000 character chunks to stay within token limits
-    all_embeddings = process_remaining_pdfs(batch_size=3, delay_between_batches=5, chunk_size=4000)
+    # Process remaining PDFs in batches of 3, starting embedding requests at most every 5 seconds
+    # Using chunks of about 1000 tokens, well within the embedding model's limit
+    total_stored = process_remaining_pdfs(batch_size=3, delay_between_batches=5, chunk_tokens=1000)
     
     print("\nAll remaining PDFs have been processed and their embeddings stored in Pinecone.")
     print("You can now deploy your formulary agent to Streamlit for nurse access.")
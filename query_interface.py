@@ -13,6 +13,7 @@ import openai
 import pinecone
 import pandas as pd
 from dotenv import load_dotenv
+from pinecone import Pinecone
 from document_processor import DocumentProcessor
 from formulary_agent import FormularyAgent, FormularyResponse
 
@@ -29,6 +30,9 @@ class FormularyQueryInterface:
         self.agent = FormularyAgent()
         self.client = openai.OpenAI(api_key=OPENAI_API_KEY)
         
+        # One Pinecone client and index handle, reused by every query and upload
+        self._index = Pinecone(api_key=PINECONE_API_KEY).Index("form")
+        
     def direct_query(self, query_text: str) -> str:
         """
         Process a direct natural language query using GPT-4o
@@ -62,31 +66,26 @@ class FormularyQueryInterface:
             # Get embedding for the query
             query_embedding = self.processor.get_embedding(query)
             
-            # Query Pinecone using the latest API
-            from pinecone import Pinecone
-            pc = Pinecone(api_key=PINECONE_API_KEY)
-            index = pc.Index("form")  # Use the existing index name
-            
             # Query in the exact format from the documentation
-            results = index.query(
+            results = self._index.query(
                 namespace=namespace,
-                vector=query_embedding,
+                vector=query_embedding.tolist(),
                 top_k=top_k,
                 include_values=True,
                 include_metadata=True
             )
             
-            # Format context from results
-            context = ""
+            # Format context from results, joining the pieces once at the end
+            parts = []
             for match in results.matches:
                 metadata = match.metadata
-                context += f"Source: {metadata.get('source', 'Unknown')}\n"
-                context += f"Type: {metadata.get('type', 'Unknown')}\n"
+                parts.append(f"Source: {metadata.get('source', 'Unknown')}\n")
+                parts.append(f"Type: {metadata.get('type', 'Unknown')}\n")
                 if 'page' in metadata:
-                    context += f"Page: {metadata.get('page')}\n"
-                context += f"Content: {metadata.get('content', '')}\n\n"
+                    parts.append(f"Page: {metadata.get('page')}\n")
+                parts.append(f"Content: {metadata.get('content', '')}\n\n")
             
-            return context
+            return "".join(parts)
         except Exception as e:
             print(f"Error retrieving context: {e}")
             return "No relevant context found."
@@ -146,10 +145,11 @@ class FormularyQueryInterface:
             insurance_name = input("Insurance name (e.g., UnitedHealthcare, Aetna): ")
             
             print("\nSelect medication class (enter number):")
-            for i, med_class in enumerate(self.agent.get_medication_classes(), 1):
+            medication_classes = self.agent.get_medication_classes()
+            for i, med_class in enumerate(medication_classes, 1):
                 print(f"{i}. {med_class}")
             class_choice = int(input("\nChoice: "))
-            medication_class = self.agent.get_medication_classes()[class_choice-1]
+            medication_class = medication_classes[class_choice-1]
             
             print("\nBrand preference:")
             print("1. Generic preferred")
@@ -233,14 +233,13 @@ class FormularyQueryInterface:
                     print(f"Processing {filename}...")
                     
                     # Extract text and tables
-                    text = self.processor.extract_text_from_pdf(pdf_path)
-                    tables = self.processor.extract_tables_from_pdf(pdf_path)
+                    text, tables = self.processor.extract_text_and_tables(pdf_path)
                     
                     # Create embeddings
                     if text:
                         print(f"Creating embedding for full text...")
                         text_embedding = self.processor.get_embedding(text)
-                        if text_embedding:
+                        if text_embedding is not None:
                             all_embeddings.append({
                                 'content': text[:1000] + '...',
                                 'embedding': text_embedding,
@@ -251,23 +250,24 @@ class FormularyQueryInterface:
                     for i, table in enumerate(tables):
                         if isinstance(table['data'], pd.DataFrame) and not table['data'].empty:
                             print(f"Creating embedding for table {i+1}...")
-                            table_str = table['data'].to_string()
+                            table_str = table['data'].iloc[:200, :40].to_csv(index=False)
                             table_embedding = self.processor.get_embedding(table_str)
-                            if table_embedding:
+                            if table_embedding is not None:
                                 all_embeddings.append({
                                     'content': f"Table from page {table['page']}:\n{table_str[:500]}...",
                                     'embedding': table_embedding,
                                     'metadata': {
                                         'source': filename,
                                         'type': 'table',
-                                        'page': table['page']
+                                        'page': table['page'],
+                                        'table_num': table['table_num']
                                     }
                                 })
                 
                 # Store in Pinecone
                 if all_embeddings:
                     print(f"\nStoring {len(all_embeddings)} embeddings in Pinecone...")
-                    success = self.processor.store_in_pinecone(all_embeddings)
+                    success = self.processor.store_in_pinecone(all_embeddings, index=self._index)
                     if success:
                         print(f"Successfully stored {len(all_embeddings)} embeddings in Pinecone")
                     else:
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+Semantic Response Cache
+-----------------------
+An in-process cache that returns a previously generated answer when a new
+query is identical to, or semantically very close to, one already answered.
+Entries can optionally be persisted to SQLite so they survive restarts and
+are shared between worker processes, and mirrored to Redis so exact repeats
+are shared between hosts.
+"""
+
+import time
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+import numpy as np
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+class SemanticCache:
+    # Embeddings are held in half precision (half the memory and scan bandwidth)
+    # and upcast to float32 a block of rows at a time when scoring
+    STORAGE_DTYPE = np.float16
+    SCORE_BLOCK = 4096
+
+    # Past ann_threshold entries, lookups go through an HNSW index (if hnswlib
+    # is installed) and check this many nearest candidates for a live entry
+    ANN_CANDIDATES = 5
+
+    def __init__(self, dim=1024, threshold=0.95, ttl=6 * 60 * 60, max_exact=512,
+                 db_path=None, purge_interval=10 * 60, redis_url=None, ann_threshold=10_000):
+        """
+        Args:
+            dim: Dimension of the query embeddings
+            threshold: Minimum cosine similarity for a semantic hit; embeddings are
+                expected to be unit length (as from DocumentProcessor.get_embedding),
+                so similarity is a plain dot product
+            ttl: Seconds before a cached answer goes stale
+            max_exact: Maximum number of exact-string entries to keep
+            db_path: Optional SQLite file used to persist and share entries
+            purge_interval: Seconds between deletions of expired rows from SQLite
+            redis_url: Optional Redis URL used as a shared exact-match tier
+            ann_threshold: Entry count above which an HNSW index replaces the flat scan
+        """
+        self.dim = dim
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_exact = max_exact
+        self.purge_interval = purge_interval
+        self.ann_threshold = ann_threshold
+        self._lock = threading.Lock()
+
+        # Exact-string fast path: normalized query -> (expires_at, response)
+        self._exact = OrderedDict()
+
+        # Semantic path: unit-length embeddings with parallel responses/expiry times
+        # and partition codes (a hit must come from the same partition as the lookup)
+        self._embeddings = np.empty((64, dim), dtype=self.STORAGE_DTYPE)
+        self._expires = np.empty(64, dtype=np.float64)
+        self._partitions = np.empty(64, dtype=np.int32)
+        self._partition_codes = {}
+        self._responses = []
+
+        # HNSW index over the same rows (labels are row positions), built lazily
+        self._ann = None
+
+        # Optional persistent store; rows newer than _last_id are not yet in memory
+        self._db = None
+        self._last_id = 0
+        self._last_purge = 0.0
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "id INTEGER PRIMARY KEY, ts REAL, query TEXT, embedding BLOB, response TEXT, partition TEXT)"
+            )
+            try:
+                # Databases created before partitions were added
+                self._db.execute("ALTER TABLE cache ADD COLUMN partition TEXT")
+            except sqlite3.OperationalError:
+                pass
+            self._db.commit()
+            with self._lock:
+                self._sync()
+
+        # Optional shared tier for exact repeats across instances
+        self._redis = None
+        if redis_url:
+            import redis
+            self._redis = redis.Redis.from_url(redis_url)
+
+    @staticmethod
+    def _normalize_query(query):
+        return " ".join(query.lower().split())
+
+    @staticmethod
+    def _redis_key(key):
+        return "cache:" + hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _vector(embedding):
+        return np.asarray(embedding, dtype=np.float32).reshape(-1)
+    
+    def _partition_code(self, partition):
+        """Small integer for a partition key; caller must hold the lock"""
+        return self._partition_codes.setdefault(partition or "", len(self._partition_codes))
+
+    def get_exact(self, query):
+        """Return the cached response for an identical query, or None"""
+        key = self._normalize_query(query)
+        with self._lock:
+            self._sync()
+            entry = self._exact.get(key)
+            if entry is not None:
+                expires_at, response = entry
+                if expires_at >= time.time():
+                    self._exact.move_to_end(key)
+                    return response
+                del self._exact[key]
+
+        if self._redis is None:
+            return None
+        try:
+            cached = self._redis.get(self._redis_key(key))
+        except Exception as e:
+            print(f"Error reading shared cache: {e}")
+            return None
+        if cached is None:
+            return None
+
+        # Promote the shared hit into the local tier
+        response = cached.decode("utf-8")
+        with self._lock:
+            self._add(key, None, response, time.time() + self.ttl)
+        return response
+
+    def get(self, query_embedding, partition=None):
+        """
+        Return the cached response for the most similar prior query, or None
+        
+        Only entries put with the same partition key are considered, so queries that
+        embed closely but differ in a decisive term (a provider, a drug class) never
+        share an answer.
+        """
+        if query_embedding is None:
+            return None
+        q = self._vector(query_embedding)
+        with self._lock:
+            self._sync()
+            n = len(self._responses)
+            if n == 0:
+                return None
+            code = self._partition_code(partition)
+            if self._ann is not None:
+                return self._ann_lookup(q, n, code)
+            sims = self._scores(q, n)
+            sims[(self._expires[:n] < time.time()) | (self._partitions[:n] != code)] = -1.0
+            best = int(np.argmax(sims))
+            if sims[best] > self.threshold:
+                return self._responses[best]
+            return None
+
+    def _scores(self, q, n):
+        """Dot products of q with the first n cached embeddings; caller must hold the lock"""
+        sims = np.empty(n, dtype=np.float32)
+        for start in range(0, n, self.SCORE_BLOCK):
+            stop = min(start + self.SCORE_BLOCK, n)
+            sims[start:stop] = self._embeddings[start:stop].astype(np.float32) @ q
+        return sims
+
+    def _ann_lookup(self, q, n, code):
+        """Nearest live entry in the partition above the threshold via HNSW; caller must hold the lock"""
+        labels, distances = self._ann.knn_query(q, k=min(self.ANN_CANDIDATES, n))
+        now = time.time()
+        for label, distance in zip(labels[0], distances[0]):
+            # Cosine space distance is 1 - similarity, and results come nearest first
+            if 1.0 - distance <= self.threshold:
+                break
+            if self._expires[label] >= now and self._partitions[label] == code:
+                return self._responses[label]
+        return None
+
+    def _build_ann(self, n):
+        """Index the first n rows with HNSW; caller must hold the lock"""
+        index = hnswlib.Index(space='cosine', dim=self.dim)
+        index.init_index(max_elements=self._embeddings.shape[0], ef_construction=200, M=16)
+        index.add_items(self._embeddings[:n].astype(np.float32), np.arange(n))
+        self._ann = index
+
+    def put(self, query, query_embedding, response, partition=None):
+        """Cache a response under both its exact query and its embedding (within a partition)"""
+        now = time.time()
+        key = self._normalize_query(query)
+        embedding = None if query_embedding is None else self._vector(query_embedding)
+        if self._redis is not None:
+            try:
+                self._redis.set(self._redis_key(key), response, ex=int(self.ttl))
+            except Exception as e:
+                print(f"Error writing shared cache: {e}")
+
+        with self._lock:
+            if self._db is None:
+                self._add(key, embedding, response, now + self.ttl, partition)
+                return
+
+            # Write through to SQLite, then pick the row up (with any from other workers)
+            try:
+                self._db.execute(
+                    "INSERT INTO cache (ts, query, embedding, response, partition) VALUES (?, ?, ?, ?, ?)",
+                    (now, key, None if embedding is None else embedding.tobytes(), response, partition)
+                )
+                if now - self._last_purge > self.purge_interval:
+                    self._db.execute("DELETE FROM cache WHERE ts < ?", (now - self.ttl,))
+                    self._last_purge = now
+                self._db.commit()
+            except sqlite3.Error as e:
+                print(f"Error persisting cache entry: {e}")
+                self._add(key, embedding, response, now + self.ttl, partition)
+                return
+            self._sync()
+
+    def _sync(self):
+        """Load rows persisted since the last sync; caller must hold the lock"""
+        if self._db is None:
+            return
+        try:
+            rows = self._db.execute(
+                "SELECT id, ts, query, embedding, response, partition FROM cache WHERE id > ? AND ts >= ? ORDER BY id",
+                (self._last_id, time.time() - self.ttl)
+            ).fetchall()
+        except sqlite3.Error as e:
+            print(f"Error loading cache entries: {e}")
+            return
+        for row_id, ts, key, blob, response, partition in rows:
+            embedding = None if blob is None else np.frombuffer(blob, dtype=np.float32)
+            self._add(key, embedding, response, ts + self.ttl, partition)
+            self._last_id = row_id
+
+    def _add(self, key, embedding, response, expires_at, partition=None):
+        """Insert an entry into the in-memory indexes; caller must hold the lock"""
+        self._exact[key] = (expires_at, response)
+        self._exact.move_to_end(key)
+        while len(self._exact) > self.max_exact:
+            self._exact.popitem(last=False)
+
+        if embedding is None:
+            return
+        n = len(self._responses)
+        if n == self._embeddings.shape[0]:
+            n = self._compact()
+        if n == self._embeddings.shape[0]:
+            self._embeddings = np.concatenate([self._embeddings, np.empty_like(self._embeddings)])
+            self._expires = np.concatenate([self._expires, np.empty_like(self._expires)])
+            self._partitions = np.concatenate([self._partitions, np.empty_like(self._partitions)])
+            if self._ann is not None:
+                self._ann.resize_index(self._embeddings.shape[0])
+        self._embeddings[n] = embedding
+        self._expires[n] = expires_at
+        self._partitions[n] = self._partition_code(partition)
+        self._responses.append(response)
+
+        if self._ann is not None:
+            self._ann.add_items(self._embeddings[n:n + 1].astype(np.float32), [n])
+        elif hnswlib is not None and n + 1 >= self.ann_threshold:
+            self._build_ann(n + 1)
+
+    def _compact(self):
+        """Drop expired semantic entries in place; caller must hold the lock"""
+        n = len(self._responses)
+        keep = np.flatnonzero(self._expires[:n] >= time.time())
+        if keep.size < n:
+            self._embeddings[:keep.size] = self._embeddings[keep]
+            self._expires[:keep.size] = self._expires[keep]
+            self._partitions[:keep.size] = self._partitions[keep]
+            self._responses = [self._responses[i] for i in keep]
+            # Row positions moved, so the HNSW labels are stale; rebuilt on the next add
+            self._ann = None
+        return keep.size
@@ -7,11 +7,25 @@ across different insurance formularies with a focus on respiratory medications.
 """
 
 import os
+import re
+import time
+import asyncio
+import hashlib
+import functools
+import threading
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import pandas as pd
+import numpy as np
+import httpx
 import openai
+import orjson
+import tiktoken
 from dotenv import load_dotenv
+from pinecone import Pinecone
+from document_processor import DocumentProcessor, find_providers, insurance_filter
 from inhaler_recommender import InhalerRecommender
+from semantic_cache import SemanticCache
 
 # Load environment variables
 load_dotenv()
@@ -31,6 +45,249 @@ def get_recommender():
 
 recommender = get_recommender()
 
+# Provider and class options never change once the recommender is built
+@st.cache_data
+def provider_list():
+    return tuple(get_recommender().insurance_formularies.keys())
+
+@st.cache_data
+def med_class_list():
+    return tuple(get_recommender().medication_classes.values())
+
+# System prompt shared by the chat and direct-question paths
+SYSTEM_PROMPT = (
+    "You are a pharmacy formulary specialist who helps healthcare providers find medication information "
+    "based on insurance coverage. You ALWAYS prioritize medications with the lowest tier (Tier 1 if available) "
+    "in your recommendations, unless there are compelling clinical reasons to choose a higher tier option. "
+    "Be concise but thorough in your answers, focusing on practical information that helps clinicians "
+    "make cost-effective prescribing decisions."
+)
+
+# Clients are cached across reruns (and sessions) so each interaction skips
+# re-importing, re-authenticating and re-resolving the index
+@st.cache_resource
+def get_pinecone_http():
+    """HTTP client bound to the "form" index host; queries skip the SDK's per-match model objects"""
+    api_key = os.getenv("PINECONE_API_KEY")
+    host = Pinecone(api_key=api_key).describe_index("form").host
+    return httpx.Client(
+        base_url=f"https://{host}",
+        headers={"Api-Key": api_key, "Content-Type": "application/json"},
+        timeout=5.0
+    )
+
+@st.cache_resource
+def get_openai_client():
+    return openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+@st.cache_resource
+def get_processor():
+    return DocumentProcessor()
+
+# Query embeddings are pure functions of text and model, so repeat prompts skip the API call
+EMBEDDING_MODEL = "text-embedding-ada-002"
+
+@st.cache_data(ttl=3600, max_entries=2048)
+def embed(text, model=EMBEDDING_MODEL):
+    embedding = get_processor().get_embedding(text)
+    # Raise rather than return None, so a failed call is never cached
+    if embedding is None:
+        raise RuntimeError("Embedding request failed; please try again")
+    return embedding
+
+def _key(emb):
+    """Quantize an embedding to int8 bytes so near-identical vectors share a cache key"""
+    q = np.asarray(emb, dtype=np.float32)
+    q = np.rint(q / max(float(np.linalg.norm(q)), 1e-12) * 127).astype(np.int8)
+    return q.tobytes()
+
+# Top-k results keyed on the quantized embedding (Streamlit does not hash the leading-underscore
+# _vector argument); the REST response is parsed straight into a plain dict, which the cache can pickle
+@st.cache_data(ttl=600, max_entries=1024)
+def cached_query(key, _vector, top_k=5, namespace="formulary", provider=None):
+    query_filter = insurance_filter(provider) if provider else None
+    body = {
+        "namespace": namespace,
+        "vector": list(_vector),
+        "topK": top_k,
+        "includeValues": False,
+        "includeMetadata": True
+    }
+    if query_filter:
+        body["filter"] = query_filter
+    response = get_pinecone_http().post("/query", content=orjson.dumps(body))
+    response.raise_for_status()
+    return orjson.loads(response.content)
+
+def detect_provider(prompt):
+    """Return the first insurance provider named in a prompt (as stored in metadata), or None"""
+    providers = find_providers(prompt)
+    return providers[0] if providers else None
+
+# Full answers keyed on a hash of everything sent to the model, so a repeat of the
+# same question over the same retrieved context skips the completion entirely.
+# Persisted to SQLite so restarts start warm (query embeddings already persist
+# through DocumentProcessor's embedding cache).
+CHAT_MODEL = "gpt-4o"
+
+@st.cache_resource
+def get_answer_cache():
+    return SemanticCache(
+        dim=1024,
+        ttl=30 * 60,
+        max_exact=512,
+        db_path=os.getenv("ANSWER_CACHE_DB", "/tmp/pharm_cache.db")
+    )
+
+def answer_key(prompt, context, model=CHAT_MODEL):
+    payload = "||".join((prompt, context, SYSTEM_PROMPT, model))
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+# Streamed answers are redrawn at most every STREAM_FLUSH_SECONDS, or once
+# STREAM_FLUSH_CHARS new characters have arrived, instead of on every token
+STREAM_FLUSH_SECONDS = 0.05
+STREAM_FLUSH_CHARS = 64
+
+# Matches retrieved per (sub)query for each sidebar retrieval profile
+TOP_K_BY_PROFILE = {"fast": 3, "balanced": 5, "recall-max": 10}
+
+# Comparative prompts ("Compare Breo and Trelegy ...") are also searched per part
+_SUBQUERY_SPLIT = re.compile(r"\s+(?:and|vs\.?|versus)\s+|\bcompare\s+", re.IGNORECASE)
+
+def split_subqueries(prompt, max_parts=4):
+    """Return the prompt followed by any comparative parts worth searching on their own"""
+    parts = [part.strip(" ,.?") for part in _SUBQUERY_SPLIT.split(prompt)]
+    parts = [part for part in parts if part]
+    if len(parts) < 2:
+        return [prompt]
+    return ([prompt] + list(dict.fromkeys(parts)))[:max_parts]
+
+def _embed_and_query(ctx, q, top_k, namespace, provider):
+    # embed and cached_query are st.cache functions, so the worker thread needs the script's run context
+    add_script_run_ctx(threading.current_thread(), ctx)
+    emb = embed(q)
+    return cached_query(_key(emb), emb.tolist(), top_k, namespace, provider)
+
+async def _gather_queries(subqueries, top_k, namespace, provider):
+    ctx = get_script_run_ctx()
+    return await asyncio.gather(*[
+        asyncio.to_thread(_embed_and_query, ctx, q, top_k, namespace, provider) for q in subqueries
+    ])
+
+def _search(subqueries, top_k, namespace, provider):
+    if len(subqueries) == 1:
+        emb = embed(subqueries[0])
+        return [cached_query(_key(emb), emb.tolist(), top_k, namespace, provider)]
+    return asyncio.run(_gather_queries(subqueries, top_k, namespace, provider))
+
+def retrieve_matches(prompt, top_k=5, namespace="formulary"):
+    """Embed and search every subquery concurrently, merging matches in order without duplicates"""
+    subqueries = split_subqueries(prompt)
+    
+    # Restrict the search to a provider named in the prompt, falling back to
+    # the whole namespace if its formulary has nothing indexed
+    provider = detect_provider(prompt)
+    results = _search(subqueries, top_k, namespace, provider)
+    if provider and not any(result.get('matches') for result in results):
+        results = _search(subqueries, top_k, namespace, None)
+    
+    matches = []
+    seen = set()
+    for result in results:
+        for match in result.get('matches', []):
+            if match.get('id') in seen:
+                continue
+            seen.add(match.get('id'))
+            matches.append(match)
+    return matches
+
+# Each retrieved match gets room for one full 800-token chunk plus its source line;
+# the context budget is this times top_k, filled best matches first
+CONTEXT_TOKENS_PER_MATCH = 850
+CONTEXT_TOKEN_BUDGET = CONTEXT_TOKENS_PER_MATCH * 5
+
+@functools.lru_cache(maxsize=1)
+def _enc():
+    return tiktoken.encoding_for_model("gpt-4o")
+
+def format_context(matches, max_tokens=CONTEXT_TOKEN_BUDGET):
+    """Build the prompt context from match metadata in score order, skipping matches that overflow the token budget"""
+    ctx_parts = []
+    used = 0
+    for match in matches:
+        metadata = match.get('metadata') or {}
+        if not metadata:
+            continue
+        entry = f"Source: {metadata.get('source', 'Unknown')}\n"
+        if 'content' in metadata:
+            entry += f"Content: {metadata['content']}\n\n"
+        tokens = _enc().encode(entry, disallowed_special=())
+        if used + len(tokens) > max_tokens:
+            # Never send an empty context: cut the best match down to the budget instead
+            if not ctx_parts:
+                ctx_parts.append(_enc().decode(tokens[:max_tokens]))
+                used = max_tokens
+            continue
+        ctx_parts.append(entry)
+        used += len(tokens)
+    return "".join(ctx_parts)
+
+def answer(prompt, *, placeholder=None, top_k=5):
+    """
+    Retrieve formulary context for a question and answer it with GPT-4o.
+    
+    Args:
+        prompt: The user's question
+        placeholder: Optional st.empty() to stream the answer into as it arrives
+        top_k: Matches retrieved per (sub)query
+    
+    Returns:
+        The full answer text
+    """
+    # Embed and query Pinecone (comparative prompts fan out per part)
+    context = format_context(retrieve_matches(prompt, top_k=top_k, namespace="formulary"),
+                             max_tokens=CONTEXT_TOKENS_PER_MATCH * top_k)
+    
+    # Answer straight from the cache when this exact question and context were seen
+    answer_cache = get_answer_cache()
+    key = answer_key(prompt, context)
+    cached = answer_cache.get_exact(key)
+    if cached is not None:
+        if placeholder is not None:
+            placeholder.markdown(cached)
+        return cached
+    
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": f"Question: {prompt}\n\nRelevant formulary information:\n{context}"}
+    ]
+    client = get_openai_client()
+    if placeholder is None:
+        response = client.chat.completions.create(model=CHAT_MODEL, messages=messages)
+        full_response = response.choices[0].message.content
+    else:
+        response = client.chat.completions.create(model=CHAT_MODEL, messages=messages, stream=True)
+        
+        # Display streaming response, throttling redraws
+        parts = []
+        last_flush = time.monotonic()
+        pending_chars = 0
+        for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content is not None:
+                delta = chunk.choices[0].delta.content
+                parts.append(delta)
+                pending_chars += len(delta)
+                if pending_chars > STREAM_FLUSH_CHARS or time.monotonic() - last_flush > STREAM_FLUSH_SECONDS:
+                    placeholder.markdown("".join(parts) + "▌")
+                    last_flush = time.monotonic()
+                    pending_chars = 0
+        
+        full_response = "".join(parts)
+        placeholder.markdown(full_response)
+    
+    answer_cache.put(key, None, full_response)
+    return full_response
+
 # Custom CSS for chat-like interface
 st.markdown("""
 <style>
@@ -105,6 +362,10 @@ with st.sidebar:
     
     # Add tabs in sidebar for switching between chat and structured search
     tab_selection = st.radio("Select Interface:", ["Chat", "Structured Search"])
+    
+    # Retrieval profile trades context breadth for query latency
+    ann_profile = st.selectbox("Retrieval profile", list(TOP_K_BY_PROFILE), index=1)
+    top_k = TOP_K_BY_PROFILE[ann_profile]
 
 # Initialize session state for chat history if it doesn't exist
 if "messages" not in st.session_state:
@@ -135,57 +396,9 @@ if tab_selection == "Chat":
         # Display assistant response in chat message container
         with st.chat_message("assistant"):
             message_placeholder = st.empty()
-            full_response = ""
             
             try:
-                # Use the processor to get embedding and query Pinecone
-                from document_processor import DocumentProcessor
-                processor = DocumentProcessor()
-                
-                # Get embedding for the query
-                query_embedding = processor.get_embedding(prompt)
-                
-                # Query Pinecone
-                from pinecone import Pinecone
-                pc = Pinecone(api_key=os.getenv("PINECONE_API_KEY"))
-                index = pc.Index("form")
-                
-                results = index.query(
-                    namespace="formulary",
-                    vector=query_embedding,
-                    top_k=5,
-                    include_values=False,
-                    include_metadata=True
-                )
-                
-                # Format context from results
-                context = ""
-                for match in results.matches:
-                    if hasattr(match, 'metadata') and match.metadata:
-                        metadata = match.metadata
-                        context += f"Source: {metadata.get('source', 'Unknown')}\n"
-                        if 'content' in metadata:
-                            context += f"Content: {metadata.get('content')}\n\n"
-                
-                # Generate response with GPT-4o
-                client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-                
-                response = client.chat.completions.create(
-                    model="gpt-4o",
-                    messages=[
-                        {"role": "system", "content": "You are a pharmacy formulary specialist who helps healthcare providers find medication information based on insurance coverage. You ALWAYS prioritize medications with the lowest tier (Tier 1 if available) in your recommendations, unless there are compelling clinical reasons to choose a higher tier option. Be concise but thorough in your answers, focusing on practical information that helps clinicians make cost-effective prescribing decisions."},
-                        {"role": "user", "content": f"Question: {prompt}\n\nRelevant formulary information:\n{context}"}
-                    ],
-                    stream=True
-                )
-                
-                # Display streaming response
-                for chunk in response:
-                    if chunk.choices and chunk.choices[0].delta.content is not None:
-                        full_response += chunk.choices[0].delta.content
-                        message_placeholder.markdown(full_response + "▌")
-                
-                message_placeholder.markdown(full_response)
+                full_response = answer(prompt, placeholder=message_placeholder, top_k=top_k)
                 
             except Exception as e:
                 error_message = f"Error: {str(e)}"
@@ -205,20 +418,17 @@ else:  # Structured Search
         st.subheader("Required Information")
         
         # Insurance provider selection
-        providers = list(recommender.insurance_formularies.keys())
         insurance_provider = st.selectbox(
             "Insurance Provider",
-            options=providers,
+            options=provider_list(),
             index=None,
             placeholder="Select insurance provider"
         )
         
         # Medication class selection
-        med_classes = recommender.medication_classes
-        med_class_options = list(med_classes.values())
         medication_class = st.selectbox(
             "Medication Class Needed",
-            options=med_class_options,
+            options=med_class_list(),
             index=None,
             placeholder="Select medication class"
         )
@@ -341,49 +551,11 @@ with tab2:
         else:
             with st.spinner("Searching formulary database..."):
                 try:
-                    # Use the processor to get embedding and query Pinecone
-                    from document_processor import DocumentProcessor
-                    processor = DocumentProcessor()
-                    
-                    # Get embedding for the query
-                    query_embedding = processor.get_embedding(query)
-                    
-                    # Query Pinecone
-                    from pinecone import Pinecone
-                    pc = Pinecone(api_key=os.getenv("PINECONE_API_KEY"))
-                    index = pc.Index("form")
-                    
-                    results = index.query(
-                        namespace="formulary",
-                        vector=query_embedding,
-                        top_k=5,
-                        include_values=False,
-                        include_metadata=True
-                    )
-                    
-                    # Format context from results
-                    context = ""
-                    for match in results.matches:
-                        if hasattr(match, 'metadata') and match.metadata:
-                            metadata = match.metadata
-                            context += f"Source: {metadata.get('source', 'Unknown')}\n"
-                            if 'content' in metadata:
-                                context += f"Content: {metadata.get('content')}\n\n"
-                    
-                    # Generate response with GPT-4o
-                    client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-                    
-                    response = client.chat.completions.create(
-                        model="gpt-4o",
-                        messages=[
-                            {"role": "system", "content": "You are a pharmacy formulary specialist who helps healthcare providers find medication information based on insurance coverage. You ALWAYS prioritize medications with the lowest tier (Tier 1 if available) in your recommendations, unless there are compelling clinical reasons to choose a higher tier option."},
-                            {"role": "user", "content": f"Question: {query}\n\nRelevant formulary information:\n{context}"}
-                        ]
-                    )
+                    text = answer(query, top_k=top_k)
                     
                     # Display response
                     st.subheader("Answer")
-                    st.markdown(response.choices[0].message.content)
+                    st.markdown(text)
                     
                 except Exception as e:
                     st.error(f"Error: {str(e)}")
@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+"""
+Cache Partition Test
+--------------------
+Checks that the semantic response cache never lets questions about different
+drugs or providers share a partition.
+"""
+
+from document_processor import cache_partition
+
+def test_same_class_drugs_get_different_partitions():
+    """Two ICS inhalers on the same plan must not share cached answers"""
+    assert cache_partition("Is Flovent covered by BCBS?") != cache_partition("Is Pulmicort covered by BCBS?")
+
+def test_drugs_outside_the_recommender_examples_are_told_apart():
+    """Brands only listed in MED_CLASS_TERMS are still partition keys"""
+    partitions = {cache_partition(f"Is {drug} covered by BCBS?") for drug in ("Arnuity", "Alvesco", "Wixela", "Advair")}
+    assert None not in partitions
+    assert len(partitions) == 4
+
+def test_providers_get_different_partitions():
+    """The same drug on two insurers must not share cached answers"""
+    assert cache_partition("Is Symbicort covered on Humana?") != cache_partition("Is Symbicort covered on Cigna?")
+
+def test_rephrasings_share_a_partition():
+    """Case and wording around the same drug and provider do not change the partition"""
+    assert cache_partition("Is Flovent covered by BCBS?") == cache_partition("does blue cross blue shield cover flovent")
+
+def test_questions_without_a_known_drug_have_no_partition():
+    """Questions naming no known drug fall back to exact matches only"""
+    assert cache_partition("What is the lowest tier option on Cigna?") is None
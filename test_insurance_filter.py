@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""
+Insurance Filter Test
+---------------------
+Checks that providers named in questions produce Pinecone filters matching the
+insurance metadata that ingestion stores for their formulary files.
+"""
+
+import pytest
+from document_processor import (
+    INSURANCE_PROVIDERS, PLAN_TYPES, PROVIDER_ALIASES,
+    find_providers, get_insurance_from_filename, insurance_filter
+)
+
+@pytest.mark.parametrize("key", list(INSURANCE_PROVIDERS))
+@pytest.mark.parametrize("plan", [None] + list(PLAN_TYPES))
+def test_filename_round_trips_through_filter(key, plan):
+    """The stored insurance value for a formulary filename is matched by the filter for its provider"""
+    filename = f"4-25 {key} {plan} Formulary.pdf" if plan else f"4-25 {key} Formulary.pdf"
+    stored = get_insurance_from_filename(filename)
+
+    providers = find_providers(f"What tier is Advair on {INSURANCE_PROVIDERS[key]}?")
+    assert providers == [INSURANCE_PROVIDERS[key]]
+    assert stored in insurance_filter(providers[0])["insurance"]["$in"]
+
+@pytest.mark.parametrize("alias", list(PROVIDER_ALIASES))
+def test_aliases_map_to_stored_values(alias):
+    """Every alias resolves to a provider value that ingestion actually stores"""
+    assert find_providers(f"Is Symbicort covered by {alias}?") == [PROVIDER_ALIASES[alias]]
+    assert PROVIDER_ALIASES[alias] in INSURANCE_PROVIDERS.values()
+
+def test_county_care_spellings():
+    """Both spellings of County Care reach the stored "County Care" vectors"""
+    stored = get_insurance_from_filename("4-25 County Care Formulary.pdf")
+    for question in ("Does CountyCare cover Breo?", "Does County Care cover Breo?"):
+        assert stored in insurance_filter(find_providers(question)[0])["insurance"]["$in"]
+    assert stored in insurance_filter("CountyCare")["insurance"]["$in"]
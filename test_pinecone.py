@@ -6,6 +6,7 @@ Simple script to test the Pinecone connection and API key.
 """
 
 import os
+import numpy as np
 from dotenv import load_dotenv
 from pinecone import Pinecone
 
@@ -34,10 +35,12 @@ def test_pinecone_connection():
             stats = index.describe_index_stats()
             print(f"\nIndex stats: {stats}")
             
-            # Test a simple upsert with a single vector
+            # Test a simple upsert with a single vector; the values are built once
+            # and reused for the query
+            values = np.full(1024, 0.1, dtype=np.float32).tolist()  # 1024-dimensional vector
             test_vector = {
                 'id': 'test_vector',
-                'values': [0.1] * 1024,  # 1024-dimensional vector
+                'values': values,
                 'metadata': {'test': 'test'}
             }
             
@@ -49,7 +52,7 @@ def test_pinecone_connection():
             print("\nAttempting to query the test vector...")
             results = index.query(
                 namespace="test",
-                vector=[0.1] * 1024,
+                vector=values,
                 top_k=1,
                 include_values=True,
                 include_metadata=True